@@ -0,0 +1,114 @@
+import copy
+import hashlib
+import html as html_lib
+import json
+import random
+
+from aiohttp import web
+from bs4 import BeautifulSoup
+
+ITEM_TEMPLATE = (
+    '<div class="ProductList-item">'
+    '<a href="/fragrance/p/{slug}"><img data-src="https://images.example.com/{slug}.jpg"/></a>'
+    '{sold_out}<h1>{name}</h1>'
+    '</div>'
+)
+SOLD_OUT_MARK = '<div class="product-mark sold-out">sold out</div>'
+DETAIL_TEMPLATE = '<html><body><div class="product-variants" data-variants="{variants}"></div></body></html>'
+SIZES = ("30ml", "50ml", "100ml")
+
+
+def generate_catalog(size, sold_out_ratio=0.3, seed=0):
+    """Builds a listing page with `size` synthetic products shaped like the Montagne catalog."""
+    rng = random.Random(seed)
+    items = []
+    for i in range(size):
+        sold_out = SOLD_OUT_MARK if rng.random() < sold_out_ratio else ""
+        items.append(ITEM_TEMPLATE.format(slug=f"product-{i}", name=f"Fragrance No. {i}", sold_out=sold_out))
+    return f"<html><body><div class=\"ProductList\">{''.join(items)}</div></body></html>"
+
+
+def resize_saved_catalog(html, size):
+    """Repeats or truncates the products of a saved listing page to get `size` items."""
+    soup = BeautifulSoup(html, "lxml")
+    items = soup.findAll("div", class_="ProductList-item")
+    if not items:
+        raise ValueError("The saved page contains no ProductList-item entries.")
+
+    container = items[0].parent
+    for item in items:
+        item.extract()
+
+    for i in range(size):
+        item = copy.copy(items[i % len(items)])
+        if i >= len(items) and item.find('h1'):
+            item.find('h1').string = f"{item.find('h1').text.strip()} #{i // len(items)}"
+        container.append(item)
+    return str(soup)
+
+
+def toggle_stock(html, ratio, seed=0):
+    """Flips the sold-out badge on roughly `ratio` of the products."""
+    rng = random.Random(seed)
+    soup = BeautifulSoup(html, "lxml")
+    for item in soup.findAll("div", class_="ProductList-item"):
+        if rng.random() >= ratio:
+            continue
+        marker = item.find('div', class_='product-mark sold-out')
+        if marker:
+            marker.decompose()
+        else:
+            item.insert(0, BeautifulSoup(SOLD_OUT_MARK, "html.parser"))
+    return str(soup)
+
+
+def generate_detail_page(slug):
+    """A product page whose per-size stock is derived from the slug."""
+    rng = random.Random(slug)
+    variants = [{"attributes": {"Size": size}, "qtyInStock": rng.choice((0, 0, 3, 12)), "unlimited": False}
+                for size in SIZES]
+    return DETAIL_TEMPLATE.format(variants=html_lib.escape(json.dumps(variants)))
+
+
+class FakeStoreServer:
+    """Serves `self.html` as the fragrance listing page and a product page per slug, with ETags."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.html = generate_catalog(0)
+        self.requests = 0
+        self.detail_requests = 0
+        self.not_modified = 0
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/fragrance"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/fragrance", self._handle)
+        app.router.add_get("/fragrance/p/{slug}", self._handle_detail)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request):
+        self.requests += 1
+        return web.Response(text=self.html, content_type="text/html")
+
+    async def _handle_detail(self, request: web.Request):
+        self.detail_requests += 1
+        page = generate_detail_page(request.match_info["slug"])
+        etag = f'"{hashlib.md5(page.encode()).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=page, content_type="text/html", headers={"ETag": etag})
@@ -0,0 +1,98 @@
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeTelegramServer:
+    """A local Bot API stand-in that records every call and can inject 429/403 errors.
+
+    Point aiogram at it with `TelegramAPIServer.from_base(server.url)`.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, rate_limit_ratio=0.0, forbidden_ratio=0.0,
+                 retry_after=1, seed=0):
+        self.host = host
+        self.port = port
+        self.rate_limit_ratio = rate_limit_ratio
+        self.forbidden_ratio = forbidden_ratio
+        self.retry_after = retry_after
+        self.inject_errors = True
+        self.calls = Counter()
+        self.errors = Counter()
+        self.recipients = Counter()
+        self._random = random.Random(seed)
+        self._message_id = 0
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def reset(self):
+        self.calls.clear()
+        self.errors.clear()
+        self.recipients.clear()
+
+    async def _handle(self, request: web.Request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+
+        if method in ("sendMessage", "sendPhoto") and self.inject_errors:
+            roll = self._random.random()
+            if roll < self.rate_limit_ratio:
+                self.errors[429] += 1
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                   parameters={"retry_after": self.retry_after})
+            if roll < self.rate_limit_ratio + self.forbidden_ratio:
+                self.errors[403] += 1
+                return self._error(403, "Forbidden: bot was blocked by the user")
+
+        if method in ("sendMessage", "sendPhoto"):
+            self.recipients[data.get("chat_id")] += 1
+
+        return web.json_response({"ok": True, "result": self._result(method, data)})
+
+    def _result(self, method, data):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method in ("sendMessage", "sendPhoto", "editMessageText", "editMessageReplyMarkup"):
+            self._message_id += 1
+            message = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+            }
+            if "text" in data:
+                message["text"] = data["text"]
+            if "caption" in data:
+                message["caption"] = data["caption"]
+            if "reply_markup" in data:
+                markup = json.loads(data["reply_markup"])
+                if "inline_keyboard" in markup:
+                    message["reply_markup"] = markup
+            return message
+        return True
+
+    @staticmethod
+    def _error(code, description, parameters=None):
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return web.json_response(payload, status=code)
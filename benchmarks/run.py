@@ -0,0 +1,319 @@
+"""Offline load tests for the bot.
+
+Runs the real handlers, scraper and fan-out code against local stand-ins: a fake Bot API
+server, a fake store and fakeredis. Nothing leaves the machine.
+
+    $ pip install -r benchmarks/requirements.txt
+    $ python -m benchmarks.run --output bench.json
+
+Compare two JSON reports to spot regressions between commits.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks.fake_store import FakeStoreServer, generate_catalog, resize_saved_catalog, toggle_stock
+from benchmarks.fake_telegram import FakeTelegramServer
+
+ROOT = Path(__file__).resolve().parent.parent
+BOT_TOKEN = "123456:BENCHMARK-TOKEN"
+ADMIN_USER_ID = 1
+
+USER_FLOW = ["/start", "📄 Wishlist", "🔍 Fragrances", "⚙️ Settings", "◀️ Back to menu"]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+        "max_ms": round(max(values) * 1000, 3) if values else None,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_update(update_id, user_id, text):
+    from aiogram.types import Chat, Message, Update, User
+
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=user_id, type="private"),
+        from_user=User(id=user_id, is_bot=False, first_name=f"user{user_id}"),
+        text=text,
+    ))
+
+
+async def clear_outbox():
+    from sqlalchemy import delete
+    from src.database.models import Delivery, OutboxEvent
+    from src.database.requests import async_session
+
+    async with async_session() as session:
+        await session.execute(delete(Delivery))
+        await session.execute(delete(OutboxEvent))
+        await session.commit()
+
+
+async def seed_subscribers(count):
+    from sqlalchemy import delete, insert
+    from src.database.models import Wishlist, wishlist_fragrance
+    from src.database.requests import async_session
+
+    async with async_session() as session:
+        await session.execute(delete(wishlist_fragrance))
+        await session.execute(delete(Wishlist))
+        rows = [{"telegram_id": 1_000_000 + i, "receive_notification": True} for i in range(count)]
+        for i in range(0, len(rows), 5000):
+            await session.execute(insert(Wishlist), rows[i:i + 5000])
+        await session.commit()
+
+
+async def bench_handlers(bot, redis, http, telegram, users, concurrency):
+    from src.bootstrap import build_dispatcher
+
+    dp = build_dispatcher(redis=redis, http=http)
+    latencies = {text: [] for text in USER_FLOW}
+    semaphore = asyncio.Semaphore(concurrency)
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def run_user(user_id):
+        for text in USER_FLOW:
+            async with semaphore:
+                started = time.perf_counter()
+                await dp.feed_update(bot, make_update(next(update_ids), user_id, text))
+                latencies[text].append(time.perf_counter() - started)
+
+    # Handlers do not expect send errors, so only the fan-out benchmark injects them.
+    telegram.reset()
+    telegram.inject_errors = False
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_user(10_000 + i) for i in range(users)))
+    finally:
+        telegram.inject_errors = True
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "users": users,
+        "concurrency": concurrency,
+        "updates_per_second": round(len(all_latencies) / elapsed, 1),
+        "overall": summarize(all_latencies),
+        "by_action": {text: summarize(values) for text, values in latencies.items()},
+        "api_calls": dict(telegram.calls),
+    }
+
+
+async def bench_scrape(redis, http, store, sizes, toggle_ratio, saved_html):
+    from sqlalchemy import delete
+    from src.database.models import Fragrance, FragranceVariant, StockHistory, wishlist_fragrance
+    from src.database.requests import async_session
+    from src.services import parsing
+
+    parsing.MONTAGNE_URL = store.url
+    await seed_subscribers(0)
+    results = []
+    for size in sizes:
+        await clear_outbox()
+        async with async_session() as session:
+            await session.execute(delete(wishlist_fragrance))
+            await session.execute(delete(FragranceVariant))
+            await session.execute(delete(StockHistory))
+            await session.execute(delete(Fragrance))
+            await session.commit()
+
+        html = resize_saved_catalog(saved_html, size) if saved_html else generate_catalog(size)
+        store.html = html
+        started = time.perf_counter()
+        await parsing.update_fragrances(redis, http)
+        initial = time.perf_counter() - started
+
+        store.html = toggle_stock(html, toggle_ratio)
+        started = time.perf_counter()
+        await parsing.update_fragrances(redis, http)
+        changed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await parsing.update_fragrances(redis, http)
+        unchanged = time.perf_counter() - started
+
+        # First crawl fetches every product page, the next one only the products that changed
+        store.detail_requests = store.not_modified = 0
+        started = time.perf_counter()
+        await parsing.update_fragrances(redis, http, crawl_details=True)
+        details = time.perf_counter() - started
+        details_fetched = store.detail_requests
+
+        store.html = toggle_stock(store.html, toggle_ratio, seed=1)
+        store.detail_requests = store.not_modified = 0
+        started = time.perf_counter()
+        await parsing.update_fragrances(redis, http, crawl_details=True)
+        details_changed = time.perf_counter() - started
+
+        results.append({
+            "catalog_size": size,
+            "initial_cycle_s": round(initial, 4),
+            "changed_cycle_s": round(changed, 4),
+            "unchanged_cycle_s": round(unchanged, 4),
+            "details_cycle_s": round(details, 4),
+            "details_fetched": details_fetched,
+            "details_changed_cycle_s": round(details_changed, 4),
+            "details_refetched": store.detail_requests,
+            "details_not_modified": store.not_modified,
+            "toggle_ratio": toggle_ratio,
+        })
+    return results
+
+
+async def bench_fanout(bot, telegram, subscriber_counts):
+    from src.database.models import Fragrance
+    from src.database.requests import async_session
+    from src.services import notifications
+
+    results = []
+    for count in subscriber_counts:
+        await clear_outbox()
+        await seed_subscribers(count)
+        async with async_session() as session:
+            fragrance = Fragrance(name="BENCHMARK FRAGRANCE", image_url="https://images.example.com/bench.jpg")
+            session.add_all(notifications.new_fragrance_events(fragrance))
+            await session.commit()
+
+        telegram.reset()
+        started = time.perf_counter()
+        while await notifications.process_outbox(bot):
+            pass
+        elapsed = time.perf_counter() - started
+        delivered = len(telegram.recipients)
+        results.append({
+            "subscribers": count,
+            "completion_s": round(elapsed, 3),
+            "delivered": delivered,
+            "sends_per_second": round(delivered / elapsed, 1) if elapsed else None,
+            "api_calls": dict(telegram.calls),
+            "injected_errors": {str(code): n for code, n in telegram.errors.items()},
+        })
+    return results
+
+
+async def run(args):
+    import aiohttp
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from fakeredis.aioredis import FakeRedis
+    from sqlalchemy.engine import make_url
+
+    from config.config import DatabaseConfig
+    from src.database import requests
+    from src.database.migrations import run_migrations
+    from src.database.models import create_engine_from_config, create_session_factory
+    from src.services import crawler, notifications, runtime_settings
+
+    redis = FakeRedis()
+    await runtime_settings.set_admin_prioritize(redis, False)
+    await runtime_settings.load(redis, ADMIN_USER_ID)
+
+    notifications.SEND_BATCH_DELAY = args.batch_delay
+    crawler.HOST_RATE = args.detail_host_rate
+    engine = create_engine_from_config(DatabaseConfig(url=args.database_url, pool_size=10, max_overflow=20))
+    await run_migrations(engine)
+    requests.bind(engine, create_session_factory(engine))
+
+    telegram = FakeTelegramServer(rate_limit_ratio=args.rate_limit_ratio, forbidden_ratio=args.forbidden_ratio)
+    store = FakeStoreServer()
+    await telegram.start()
+    await store.start()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(telegram.url))
+    bot = Bot(token=BOT_TOKEN, session=session)
+    http = aiohttp.ClientSession()
+
+    saved_html = Path(args.saved_html).read_text() if args.saved_html else None
+    try:
+        report = {
+            "revision": git_revision(),
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "settings": {
+                "database": make_url(args.database_url).get_backend_name(),
+                "batch_delay_s": args.batch_delay,
+                "detail_host_rate": args.detail_host_rate,
+                "rate_limit_ratio": args.rate_limit_ratio,
+                "forbidden_ratio": args.forbidden_ratio,
+            },
+            "scrape": await bench_scrape(redis, http, store, args.catalog_sizes, args.toggle_ratio, saved_html),
+            "handlers": await bench_handlers(bot, redis, http, telegram, args.users, args.concurrency),
+            "fanout": await bench_fanout(bot, telegram, args.subscribers),
+        }
+    finally:
+        await http.close()
+        await session.close()
+        await telegram.stop()
+        await store.stop()
+        await engine.dispose()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500, help="synthetic users driven through the dispatcher")
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at the same time")
+    parser.add_argument("--catalog-sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--toggle-ratio", type=float, default=0.05, help="share of products changing stock")
+    parser.add_argument("--saved-html", help="saved listing page to replay instead of a synthetic catalog")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[10_000, 50_000, 100_000])
+    parser.add_argument("--detail-host-rate", type=float, default=200, help="overrides crawler.HOST_RATE")
+    parser.add_argument("--batch-delay", type=float, default=0.0, help="overrides SEND_BATCH_DELAY")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.01, help="share of sends answered with 429")
+    parser.add_argument("--forbidden-ratio", type=float, default=0.02, help="share of sends answered with 403")
+    parser.add_argument("--database-url", default="sqlite+aiosqlite:///bench.sqlite3",
+                        help="database to benchmark against; its tables are wiped")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.saved_html:
+        args.saved_html = os.path.abspath(args.saved_html)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # The database and log paths are relative, so run inside a scratch directory
+    # before anything from `src` is imported.
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as workdir:
+        os.chdir(workdir)
+        logging.disable(logging.CRITICAL)
+        report = asyncio.run(run(args))
+        os.chdir(ROOT)
+
+    payload = json.dumps(report, indent=2, ensure_ascii=False)
+    if output:
+        Path(output).write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,50 +1,42 @@
 import asyncio
 import logging
-from datetime import datetime
-
-from aiogram import Bot, Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.types import Message, Chat
 
 from config import Config, load_config
 from config import config
-from src.database.models import async_main
-from src.handlers import handlers
-
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-
-from src.services.parsing import update_fragrances
+from src.bootstrap import create_app, close_app
+from src.services import metrics, runtime_settings, subscriptions
+from src.services.consumers import start_consumers
+from src.services.notifications import run_notifier
 
 config.setup_logging()
 logger = logging.getLogger(__name__)
 
 
-def create_dummy_message(bot: Bot):
-    chat = Chat(id=0, type='private')
-    msg = Message(message_id=0, date=datetime.now(), chat=chat, bot=bot)
-
-    return msg
-
-
 async def main():
     logger.info("Starting bot")
-    await async_main()
     config: Config = load_config()
 
-    bot: Bot = Bot(token=config.tg_bot.token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp: Dispatcher = Dispatcher()
+    metrics.start_metrics_server(config.metrics.host, config.metrics.port)
+    lag_monitor = asyncio.create_task(metrics.monitor_event_loop_lag())
 
-    dp.include_router(handlers.router)
+    app = await create_app(config)
+    app.scheduler.start()
+    tasks = [
+        asyncio.create_task(run_notifier(app.bot)),
+        asyncio.create_task(runtime_settings.watch(app.redis)),
+        asyncio.create_task(subscriptions.watch(app.redis)),
+        *start_consumers(app.redis),
+    ]
 
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(update_fragrances, IntervalTrigger(minutes=3),
-                      args=(create_dummy_message(bot), bot))  # Pass bot and message
-    scheduler.start()
-
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        # Keep updates that arrived while the bot was restarting
+        await app.bot.delete_webhook(drop_pending_updates=False)
+        await app.dispatcher.start_polling(app.bot)
+    finally:
+        for task in tasks:
+            task.cancel()
+        lag_monitor.cancel()
+        await close_app(app)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 import os
 
+_MISSING = object()
+
 
 class ImproperlyConfigured(Exception):
     """Raises when a environment variable is missing."""
@@ -10,23 +12,26 @@ class ImproperlyConfigured(Exception):
         super().__init__(self.message, *args, **kwargs)
 
 
-def getenv(var_name: str, cast_to=str) -> str:
+def getenv(var_name: str, cast_to=str, default=_MISSING) -> str:
     """Gets an environment variable or raises an exception.
 
     Args:
         var_name: An environment variable name.
         cast_to: A type to cast.
+        default: A value returned as-is when the variable is missing.
 
     Returns:
         A value of the environment variable.
 
     Raises:
-        ImproperlyConfigured: If the environment variable is missing.
+        ImproperlyConfigured: If the environment variable is missing and no default is given.
     """
     try:
         value = os.environ[var_name]
         return cast_to(value)
     except KeyError:
+        if default is not _MISSING:
+            return default
         raise ImproperlyConfigured(var_name)
     except ValueError:
         raise ValueError(f"The value {value} can't be cast to {cast_to}.")
@@ -1,7 +1,10 @@
+import atexit
 import logging
 import os
+import queue
+import time
 from dataclasses import dataclass
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 from dotenv import load_dotenv
 
@@ -11,35 +14,201 @@ from .base import getenv
 LOG_DIR = 'logs'
 os.makedirs(LOG_DIR, exist_ok=True)
 
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+_log_listener: QueueListener | None = None
+
 
 @dataclass
 class TelegramBotConfig:
     token: str
+    admin_user_id: int | None
+
+
+@dataclass
+class MetricsConfig:
+    host: str
+    port: int
+    consumers_port: int
+
+
+@dataclass
+class RedisConfig:
+    host: str
+    port: int
+    db: int
+
+
+@dataclass
+class DatabaseConfig:
+    url: str
+    pool_size: int
+    max_overflow: int
+
+
+@dataclass
+class ScraperConfig:
+    crawl_details: bool
+
+
+@dataclass
+class ProfilingConfig:
+    scrape_cycles: int
+    handler_calls: int
 
 
 @dataclass
 class Config:
     tg_bot: TelegramBotConfig
+    metrics: MetricsConfig
+    database: DatabaseConfig
+    redis: RedisConfig
+    scraper: ScraperConfig
+    profiling: ProfilingConfig
 
 
 def load_config() -> Config:
     # Parse a `.env` file and load the variables into environment valriables
     load_dotenv()
 
-    return Config(tg_bot=TelegramBotConfig(token=getenv("BOT_TOKEN")))
+    return Config(
+        tg_bot=TelegramBotConfig(
+            token=getenv("BOT_TOKEN"),
+            admin_user_id=getenv("ADMIN_USER_ID", cast_to=int, default=None),
+        ),
+        metrics=MetricsConfig(
+            host=getenv("METRICS_HOST", default="127.0.0.1"),
+            # 9100 belongs to node_exporter; the bot and the consumers each get their own port
+            port=getenv("METRICS_PORT", cast_to=int, default=9741),
+            consumers_port=getenv("CONSUMERS_METRICS_PORT", cast_to=int, default=9742),
+        ),
+        database=DatabaseConfig(
+            url=getenv("DATABASE_URL", default="sqlite+aiosqlite:///db.sqlite3"),
+            pool_size=getenv("DATABASE_POOL_SIZE", cast_to=int, default=10),
+            max_overflow=getenv("DATABASE_MAX_OVERFLOW", cast_to=int, default=20),
+        ),
+        redis=RedisConfig(
+            host=getenv("REDIS_HOST", default="localhost"),
+            port=getenv("REDIS_PORT", cast_to=int, default=6381),
+            db=getenv("REDIS_DB", cast_to=int, default=0),
+        ),
+        scraper=ScraperConfig(
+            crawl_details=bool(getenv("CRAWL_PRODUCT_DETAILS", cast_to=int, default=0)),
+        ),
+        profiling=ProfilingConfig(
+            scrape_cycles=getenv("PROFILE_SCRAPE_CYCLES", cast_to=int, default=0),
+            handler_calls=getenv("PROFILE_HANDLER_CALLS", cast_to=int, default=0),
+        ),
+    )
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through at most `rate` records per `period` seconds for each `sample_key`.
+
+    Records logged without a `sample_key` extra are never dropped. The first record
+    let through after a window closes carries the number of suppressed records.
+    """
+
+    def __init__(self, rate: int = 20, period: float = 60.0):
+        super().__init__()
+        self.rate = rate
+        self.period = period
+        self._windows: dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample_key', None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        window = self._windows.setdefault(key, [now, 0, 0])  # [started_at, passed, suppressed]
+        if now - window[0] >= self.period:
+            if window[2]:
+                record.msg = f"{record.getMessage()} ({window[2]} similar records suppressed)"
+                record.args = None
+            window[:] = [now, 0, 0]
+
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
+
+
+class NameFilter(logging.Filter):
+    """Keeps only records from the given logger names."""
+
+    def __init__(self, *names: str):
+        super().__init__()
+        self.names = set(names)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.name in self.names
 
 
 def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        handlers=[
-            RotatingFileHandler(
-                os.path.join(LOG_DIR, 'app.log'),
-                maxBytes=1024 * 1024 * 1000,  # 1 GB
-                backupCount=5
-            ),
-            logging.StreamHandler()
-        ]
+    """Configures logging once for the whole process.
+
+    Every record goes through a `QueueHandler`; file and console output happen on the
+    `QueueListener` thread so the event loop never blocks on disk writes.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+
+    app_handler = RotatingFileHandler(
+        os.path.join(LOG_DIR, 'app.log'),
+        maxBytes=1024 * 1024 * 1000,  # 1 GB
+        backupCount=5
     )
+    new_fragrance_handler = RotatingFileHandler(
+        os.path.join(LOG_DIR, 'new_fragrance.log'),
+        maxBytes=1024 * 1024,
+        backupCount=5
+    )
+    new_fragrance_handler.addFilter(NameFilter("new_fragrance"))
+    stream_handler = logging.StreamHandler()
+
+    for handler in (app_handler, new_fragrance_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+
+    _log_listener = QueueListener(log_queue, app_handler, new_fragrance_handler, stream_handler,
+                                  respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flushes queued records and stops the listener thread."""
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    _log_listener = None
+
+
+def log_event(logger: logging.Logger, level: int, event: str, sample_key: str | None = None, **fields):
+    """Logs `event` followed by `key=value` pairs.
+
+    Pass `sample_key` for high-volume paths so `SamplingFilter` can drop bursts before
+    they reach the queue.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    message = " ".join([event, *(f"{key}={value}" for key, value in fields.items())])
+    extra = {'event': event, 'fields': fields}
+    if sample_key is not None:
+        extra['sample_key'] = sample_key
+    logger.log(level, message, extra=extra)
@@ -0,0 +1,85 @@
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config import Config
+from src.database import requests
+from src.database.migrations import run_migrations
+from src.database.models import create_engine_from_config, create_session_factory
+from src.handlers import handlers
+from src.middlewares.middlewares import UserQueueMiddleware
+from src.services import metrics, profiling, runtime_settings
+from src.services.notifications import purge_delivered
+from src.services.parsing import scrape
+
+if TYPE_CHECKING:
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+logger = logging.getLogger(__name__)
+
+SCRAPE_INTERVAL_MINUTES = 3
+OUTBOX_PURGE_INTERVAL_HOURS = 6
+
+
+@dataclass
+class Application:
+    bot: Bot
+    dispatcher: Dispatcher
+    redis: Redis
+    http: aiohttp.ClientSession
+    engine: AsyncEngine
+    scheduler: "AsyncIOScheduler"
+
+
+def build_dispatcher(**dependencies) -> Dispatcher:
+    """Creates the dispatcher; `dependencies` are injected into handlers by parameter name."""
+    dp = Dispatcher(**dependencies)
+    # Per-user ordering has to wrap the FSM middleware so the state is read under the user's lock
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(UserQueueMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+    dp.include_router(handlers.router)
+    return dp
+
+
+async def create_app(config: Config) -> Application:
+    """Migrates the database and builds every long-lived client exactly once."""
+    # APScheduler pulls in concurrent.futures.process, import it only when the app is built
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    engine = create_engine_from_config(config.database)
+    await run_migrations(engine)
+    metrics.instrument_engine(engine)
+    requests.bind(engine, create_session_factory(engine))
+    profiling.arm(profiling.SCRAPE, config.profiling.scrape_cycles)
+    profiling.arm(profiling.HANDLERS, config.profiling.handler_calls)
+
+    redis = metrics.InstrumentedRedis(host=config.redis.host, port=config.redis.port, db=config.redis.db)
+    await runtime_settings.load(redis, config.tg_bot.admin_user_id)
+    http = aiohttp.ClientSession()
+    bot = Bot(token=config.tg_bot.token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = build_dispatcher(redis=redis, http=http)
+
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(scrape, IntervalTrigger(minutes=SCRAPE_INTERVAL_MINUTES), args=(redis, http),
+                      kwargs={"crawl_details": config.scraper.crawl_details})
+    scheduler.add_job(purge_delivered, IntervalTrigger(hours=OUTBOX_PURGE_INTERVAL_HOURS))
+
+    return Application(bot=bot, dispatcher=dp, redis=redis, http=http, engine=engine, scheduler=scheduler)
+
+
+async def close_app(app: Application):
+    if app.scheduler.running:
+        app.scheduler.shutdown(wait=False)
+    await app.http.close()
+    await app.redis.aclose()
+    await app.bot.session.close()
+    await app.engine.dispose()
@@ -0,0 +1,78 @@
+"""Versioned schema migrations.
+
+Each `vNNNN_<name>.py` module in this package defines `upgrade(conn)`, which receives a
+synchronous SQLAlchemy connection. The applied version is kept in `schema_version`, so a
+start with an up-to-date schema costs a single query and no migration module is imported.
+"""
+import importlib
+import logging
+import pkgutil
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+MIGRATION_LOCK_ID = 727_001  # Arbitrary key for pg_advisory_xact_lock, shared by every worker
+
+schema_version = Table(
+    'schema_version', metadata,
+    Column('version', Integer, nullable=False)
+)
+
+
+def discover_migrations():
+    """Returns `(version, module name)` pairs sorted by version."""
+    return sorted(
+        (int(name[1:5]), name)
+        for _, name, _ in pkgutil.iter_modules(__path__)
+        if name.startswith('v') and name[1:5].isdigit()
+    )
+
+
+LATEST_VERSION = discover_migrations()[-1][0]
+
+
+def get_schema_version(conn):
+    if not inspect(conn).has_table(schema_version.name):
+        return 0
+    return conn.scalar(select(schema_version.c.version)) or 0
+
+
+def set_schema_version(conn, version):
+    metadata.create_all(conn, checkfirst=True)
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=version))
+
+
+def upgrade(conn, current):
+    applied = []
+    for version, name in discover_migrations():
+        if version <= current:
+            continue
+        logger.info(f"Applying migration {name}")
+        importlib.import_module(f"{__name__}.{name}").upgrade(conn)
+        set_schema_version(conn, version)
+        applied.append(version)
+    return applied
+
+
+async def run_migrations(engine: AsyncEngine):
+    """Brings the database schema up to `LATEST_VERSION` and returns the applied versions."""
+    async with engine.connect() as conn:
+        current = await conn.run_sync(get_schema_version)
+    if current >= LATEST_VERSION:
+        return []
+
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Workers starting together would otherwise all apply the same migrations;
+            # the lock is released when the transaction ends
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        # Re-read inside the transaction in case another worker migrated meanwhile
+        current = await conn.run_sync(get_schema_version)
+        applied = await conn.run_sync(upgrade, current)
+    logger.info(f"Database schema is at version {LATEST_VERSION}")
+    return applied
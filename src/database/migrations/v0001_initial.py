@@ -0,0 +1,34 @@
+"""Creates the initial tables.
+
+Databases created by `Base.metadata.create_all` before migrations existed already have
+these tables, so every table is created only if it is missing.
+"""
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKey, Integer, MetaData, String, Table
+
+metadata = MetaData()
+
+Table(
+    'Fragrances', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('is_sold_out', Boolean, nullable=False),
+    Column('image_url', String(500), nullable=False),
+    Column('parsed_datetime', DateTime(timezone=True), nullable=False),
+)
+
+Table(
+    'Wishlists', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('telegram_id', BigInteger, nullable=False),
+    Column('receive_notification', Boolean, nullable=False),
+)
+
+Table(
+    'wishlist_fragrance', metadata,
+    Column('wishlist_id', Integer, ForeignKey('Wishlists.id'), primary_key=True),
+    Column('fragrance_id', Integer, ForeignKey('Fragrances.id'), primary_key=True),
+)
+
+
+def upgrade(conn):
+    metadata.create_all(conn, checkfirst=True)
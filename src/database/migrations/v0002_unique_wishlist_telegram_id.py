@@ -0,0 +1,30 @@
+"""Makes `Wishlists.telegram_id` unique.
+
+Older databases may hold several wishlists per user. Their entries are merged into the
+oldest wishlist before the unique index is created.
+"""
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text(
+        'INSERT INTO wishlist_fragrance (wishlist_id, fragrance_id) '
+        'SELECT keep.id, wf.fragrance_id '
+        'FROM wishlist_fragrance wf '
+        'JOIN "Wishlists" dup ON dup.id = wf.wishlist_id '
+        'JOIN (SELECT MIN(id) AS id, telegram_id FROM "Wishlists" GROUP BY telegram_id) keep '
+        'ON keep.telegram_id = dup.telegram_id '
+        'WHERE keep.id <> dup.id '
+        'ON CONFLICT DO NOTHING'
+    ))
+    conn.execute(text(
+        'DELETE FROM wishlist_fragrance WHERE wishlist_id NOT IN '
+        '(SELECT MIN(id) FROM "Wishlists" GROUP BY telegram_id)'
+    ))
+    conn.execute(text(
+        'DELETE FROM "Wishlists" WHERE id NOT IN '
+        '(SELECT id FROM (SELECT MIN(id) AS id FROM "Wishlists" GROUP BY telegram_id) AS keep)'
+    ))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_Wishlists_telegram_id" ON "Wishlists" (telegram_id)'
+    ))
@@ -0,0 +1,37 @@
+"""Adds the notification outbox and its per-recipient delivery log."""
+from sqlalchemy import BigInteger, Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table
+
+metadata = MetaData()
+
+Table('Fragrances', metadata, Column('id', Integer, primary_key=True))
+
+Table(
+    'notification_outbox', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('kind', String(32), nullable=False),
+    Column('fragrance_id', Integer, ForeignKey('Fragrances.id'), nullable=False),
+    Column('audience', String(16), nullable=False),
+    Column('telegram_id', BigInteger, nullable=True),
+    Column('exclude_telegram_id', BigInteger, nullable=True),
+    Column('created_at', DateTime(timezone=True), nullable=False),
+    Column('available_at', DateTime(timezone=True), nullable=False),
+    Column('claimed_until', DateTime(timezone=True), nullable=True),
+    Column('expanded_at', DateTime(timezone=True), nullable=True),
+    Column('completed_at', DateTime(timezone=True), nullable=True),
+    Index('ix_notification_outbox_pending', 'completed_at', 'available_at'),
+)
+
+Table(
+    'notification_deliveries', metadata,
+    Column('event_id', Integer, ForeignKey('notification_outbox.id'), primary_key=True),
+    Column('telegram_id', BigInteger, primary_key=True),
+    Column('status', String(16), nullable=False),
+    Column('attempts', Integer, nullable=False),
+    Column('sent_at', DateTime(timezone=True), nullable=True),
+    Index('ix_notification_deliveries_status', 'event_id', 'status'),
+)
+
+
+def upgrade(conn):
+    metadata.tables['notification_outbox'].create(conn, checkfirst=True)
+    metadata.tables['notification_deliveries'].create(conn, checkfirst=True)
@@ -0,0 +1,19 @@
+"""Adds the stock history written by the analytics consumer."""
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table
+
+metadata = MetaData()
+
+Table('Fragrances', metadata, Column('id', Integer, primary_key=True))
+
+Table(
+    'stock_history', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('fragrance_id', Integer, ForeignKey('Fragrances.id'), nullable=False),
+    Column('event', String(16), nullable=False),
+    Column('occurred_at', DateTime(timezone=True), nullable=False),
+    Index('ix_stock_history_fragrance_id', 'fragrance_id'),
+)
+
+
+def upgrade(conn):
+    metadata.tables['stock_history'].create(conn, checkfirst=True)
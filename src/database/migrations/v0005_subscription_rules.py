@@ -0,0 +1,19 @@
+"""Adds per-user subscription rules matched against new and restocked fragrances."""
+from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table, UniqueConstraint
+
+metadata = MetaData()
+
+Table(
+    'subscription_rules', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('telegram_id', BigInteger, nullable=False),
+    Column('kind', String(16), nullable=False),
+    Column('pattern', String(100), nullable=False),
+    Column('created_at', DateTime(timezone=True), nullable=False),
+    UniqueConstraint('telegram_id', 'kind', 'pattern', name='uq_subscription_rules'),
+    Index('ix_subscription_rules_telegram_id', 'telegram_id'),
+)
+
+
+def upgrade(conn):
+    metadata.tables['subscription_rules'].create(conn, checkfirst=True)
@@ -0,0 +1,38 @@
+"""Adds product detail crawl state to fragrances and their per-size variant stock."""
+from sqlalchemy import (
+    Boolean, Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, UniqueConstraint, inspect
+)
+
+metadata = MetaData()
+
+Table('Fragrances', metadata, Column('id', Integer, primary_key=True))
+
+Table(
+    'fragrance_variants', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('fragrance_id', Integer, ForeignKey('Fragrances.id'), nullable=False),
+    Column('name', String(100), nullable=False),
+    Column('is_sold_out', Boolean, nullable=False),
+    Column('updated_at', DateTime(timezone=True), nullable=False),
+    UniqueConstraint('fragrance_id', 'name', name='uq_fragrance_variants'),
+    Index('ix_fragrance_variants_fragrance_id', 'fragrance_id'),
+)
+
+FRAGRANCE_COLUMNS = [
+    Column('url', String(500), nullable=True),
+    Column('etag', String(200), nullable=True),
+    Column('last_modified', String(64), nullable=True),
+    Column('details_crawled_at', DateTime(timezone=True), nullable=True),
+]
+
+
+def upgrade(conn):
+    existing = {column['name'] for column in inspect(conn).get_columns('Fragrances')}
+    preparer = conn.dialect.identifier_preparer
+    for column in FRAGRANCE_COLUMNS:
+        if column.name not in existing:
+            conn.exec_driver_sql(
+                f'ALTER TABLE "Fragrances" ADD COLUMN {preparer.quote(column.name)} '
+                f'{column.type.compile(dialect=conn.dialect)}'
+            )
+    metadata.tables['fragrance_variants'].create(conn, checkfirst=True)
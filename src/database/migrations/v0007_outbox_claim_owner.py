@@ -0,0 +1,13 @@
+"""Records which notifier holds the claim on an outbox event."""
+from sqlalchemy import Column, String, inspect
+
+CLAIMED_BY = Column('claimed_by', String(32), nullable=True)
+
+
+def upgrade(conn):
+    existing = {column['name'] for column in inspect(conn).get_columns('notification_outbox')}
+    if CLAIMED_BY.name not in existing:
+        conn.exec_driver_sql(
+            f'ALTER TABLE notification_outbox ADD COLUMN {CLAIMED_BY.name} '
+            f'{CLAIMED_BY.type.compile(dialect=conn.dialect)}'
+        )
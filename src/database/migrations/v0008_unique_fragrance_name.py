@@ -0,0 +1,40 @@
+"""Makes `Fragrances.name` unique.
+
+Two scrapers running at once could both add the same new fragrance. References to the
+duplicates are moved onto the oldest row with that name before the unique index is
+created; variants of the duplicates are dropped and crawled again.
+"""
+from sqlalchemy import text
+
+KEEP = 'SELECT MIN(id) AS id, name FROM "Fragrances" GROUP BY name'
+
+
+def upgrade(conn):
+    conn.execute(text(
+        'INSERT INTO wishlist_fragrance (wishlist_id, fragrance_id) '
+        'SELECT wf.wishlist_id, keep.id '
+        'FROM wishlist_fragrance wf '
+        'JOIN "Fragrances" dup ON dup.id = wf.fragrance_id '
+        f'JOIN ({KEEP}) keep ON keep.name = dup.name '
+        'WHERE keep.id <> dup.id '
+        'ON CONFLICT DO NOTHING'
+    ))
+    conn.execute(text(
+        f'DELETE FROM wishlist_fragrance WHERE fragrance_id NOT IN (SELECT id FROM ({KEEP}) keep)'
+    ))
+    for table in ('notification_outbox', 'stock_history'):
+        conn.execute(text(
+            f'UPDATE {table} SET fragrance_id = ('
+            f'SELECT keep.id FROM "Fragrances" dup JOIN ({KEEP}) keep ON keep.name = dup.name '
+            f'WHERE dup.id = {table}.fragrance_id) '
+            f'WHERE fragrance_id NOT IN (SELECT id FROM ({KEEP}) keep)'
+        ))
+    conn.execute(text(
+        f'DELETE FROM fragrance_variants WHERE fragrance_id NOT IN (SELECT id FROM ({KEEP}) keep)'
+    ))
+    conn.execute(text(
+        f'DELETE FROM "Fragrances" WHERE id NOT IN (SELECT id FROM ({KEEP}) keep)'
+    ))
+    conn.execute(text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "ix_Fragrances_name" ON "Fragrances" (name)'
+    ))
@@ -0,0 +1,13 @@
+"""Records which size of the fragrance an outbox event is about."""
+from sqlalchemy import Column, String, inspect
+
+VARIANT = Column('variant', String(100), nullable=True)
+
+
+def upgrade(conn):
+    existing = {column['name'] for column in inspect(conn).get_columns('notification_outbox')}
+    if VARIANT.name not in existing:
+        conn.exec_driver_sql(
+            f'ALTER TABLE notification_outbox ADD COLUMN {VARIANT.name} '
+            f'{VARIANT.type.compile(dialect=conn.dialect)}'
+        )
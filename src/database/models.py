@@ -1,13 +1,37 @@
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
-from sqlalchemy import BigInteger, String, DateTime, ForeignKey, Boolean, Integer, Table, Column
+from sqlalchemy import BigInteger, String, DateTime, ForeignKey, Boolean, Integer, Table, Column, Index, UniqueConstraint
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncEngine, async_sessionmaker, create_async_engine
 
-engine = create_async_engine(url='sqlite+aiosqlite:///db.sqlite3')
+from config.config import DatabaseConfig
 
-async_session = async_sessionmaker(engine)
+
+def create_engine_from_config(database: DatabaseConfig) -> AsyncEngine:
+    if make_url(database.url).get_backend_name() == "sqlite":
+        # SQLite has a single writer, pooling options do not apply
+        return create_async_engine(url=database.url)
+    return create_async_engine(
+        url=database.url,
+        pool_size=database.pool_size,
+        max_overflow=database.max_overflow,
+        pool_pre_ping=True,
+    )
+
+
+def create_session_factory(engine: AsyncEngine) -> async_sessionmaker:
+    return async_sessionmaker(engine, expire_on_commit=False)
+
+
+def now_almaty():
+    return datetime.now(ZoneInfo('Asia/Almaty'))
+
+
+def as_almaty(value: datetime):
+    # SQLite drops the offset, stored values are always Almaty time
+    return value if value.tzinfo else value.replace(tzinfo=ZoneInfo('Asia/Almaty'))
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -25,22 +49,95 @@ class Fragrance(Base):
     __tablename__ = "Fragrances"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    name: Mapped[str] = mapped_column(String(100))
+    name: Mapped[str] = mapped_column(String(100), unique=True, index=True)
     is_sold_out: Mapped[bool] = mapped_column(Boolean, default=False)
-    image_url: Mapped[str] = mapped_column(String(200))
-    parsed_datetime: Mapped[datetime] = mapped_column(DateTime, default=datetime.now(ZoneInfo('Asia/Almaty')))
+    image_url: Mapped[str] = mapped_column(String(500))
+    parsed_datetime: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_almaty)
+    url: Mapped[str | None] = mapped_column(String(500), nullable=True)
+    etag: Mapped[str | None] = mapped_column(String(200), nullable=True)
+    last_modified: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    details_crawled_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
     wishlists = relationship('Wishlist', secondary=wishlist_fragrance, back_populates='fragrances', lazy="selectin")
+    variants = relationship('FragranceVariant', back_populates='fragrance', lazy="raise",
+                            cascade="all, delete-orphan", order_by='FragranceVariant.id')
+
+
+class FragranceVariant(Base):
+    """Stock of one size of a fragrance, read from its product page."""
+    __tablename__ = "fragrance_variants"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    fragrance_id: Mapped[int] = mapped_column(Integer, ForeignKey('Fragrances.id'), index=True)
+    name: Mapped[str] = mapped_column(String(100))
+    is_sold_out: Mapped[bool] = mapped_column(Boolean, default=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_almaty)
+    fragrance = relationship('Fragrance', back_populates='variants')
+
+    __table_args__ = (UniqueConstraint('fragrance_id', 'name', name='uq_fragrance_variants'),)
 
 
 class Wishlist(Base):
     __tablename__ = "Wishlists"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    telegram_id: Mapped[int] = mapped_column(BigInteger)
+    telegram_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True)
     receive_notification: Mapped[bool] = mapped_column(Boolean, default=True)
     fragrances = relationship('Fragrance', secondary=wishlist_fragrance, back_populates='wishlists', lazy="selectin")
 
 
-async def async_main():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+class OutboxEvent(Base):
+    """A notification written in the same transaction as the stock change that caused it."""
+    __tablename__ = "notification_outbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(32))
+    fragrance_id: Mapped[int] = mapped_column(Integer, ForeignKey('Fragrances.id'))
+    audience: Mapped[str] = mapped_column(String(16))
+    telegram_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    exclude_telegram_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    variant: Mapped[str | None] = mapped_column(String(100), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_almaty)
+    available_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_almaty)
+    claimed_until: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    claimed_by: Mapped[str | None] = mapped_column(String(32), nullable=True)
+    expanded_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    completed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    fragrance = relationship('Fragrance', lazy="joined")
+    deliveries = relationship('Delivery', lazy="raise")
+
+    __table_args__ = (Index('ix_notification_outbox_pending', 'completed_at', 'available_at'),)
+
+
+class Delivery(Base):
+    """One recipient of an outbox event; the primary key is the idempotency key."""
+    __tablename__ = "notification_deliveries"
+
+    event_id: Mapped[int] = mapped_column(Integer, ForeignKey('notification_outbox.id'), primary_key=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    sent_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (Index('ix_notification_deliveries_status', 'event_id', 'status'),)
+
+
+class StockHistory(Base):
+    __tablename__ = "stock_history"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    fragrance_id: Mapped[int] = mapped_column(Integer, ForeignKey('Fragrances.id'), index=True)
+    event: Mapped[str] = mapped_column(String(16))
+    occurred_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+class SubscriptionRule(Base):
+    """A standing interest of a user: a keyword, a brand prefix or anything new."""
+    __tablename__ = "subscription_rules"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    telegram_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    kind: Mapped[str] = mapped_column(String(16))
+    pattern: Mapped[str] = mapped_column(String(100), default="")
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=now_almaty)
+
+    __table_args__ = (UniqueConstraint('telegram_id', 'kind', 'pattern', name='uq_subscription_rules'),)
@@ -1,21 +1,52 @@
 import logging
-from sqlalchemy import select, update
-from fuzzywuzzy import process
-from config import config
-from src.database.models import async_session, Fragrance, Wishlist
+from datetime import timedelta
+
+from sqlalchemy import select, update, delete, exists, func, literal, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from src.database.models import (
+    now_almaty, Fragrance, FragranceVariant, Wishlist, wishlist_fragrance, OutboxEvent,
+    Delivery, StockHistory, SubscriptionRule
+)
 
-config.setup_logging()
 logger = logging.getLogger(__name__)
 
+engine: AsyncEngine | None = None
+session_factory: async_sessionmaker | None = None
+
+
+def bind(database_engine: AsyncEngine, database_session_factory: async_sessionmaker):
+    """Points every request at the given database; the application bootstrap calls it once."""
+    global engine, session_factory
+    engine = database_engine
+    session_factory = database_session_factory
+
+
+def async_session():
+    if session_factory is None:
+        raise RuntimeError("The database is not bound, call bind() first.")
+    return session_factory()
+
+
+def insert_ignore(table, dialect_name=None):
+    """Builds an INSERT that silently skips rows violating a unique constraint."""
+    if isinstance(table, type):
+        table = table.__table__
+    dialect_name = dialect_name or engine.dialect.name
+    if dialect_name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect_name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    raise NotImplementedError(f"Upserts are not supported for the {dialect_name} dialect.")
+
 
 async def set_wishlist(tg_id):
     async with async_session() as session:
         try:
-            wishlist = await session.scalar(select(Wishlist).where(Wishlist.telegram_id == tg_id))
+            result = await session.execute(insert_ignore(Wishlist).values(telegram_id=tg_id))
 
-            if not wishlist:
-                new_wishlist = Wishlist(telegram_id=tg_id)
-                session.add(new_wishlist)
+            if result.rowcount:
                 logger.info(f"Added new wishlist for user with Telegram ID: {tg_id}")
             else:
                 logger.info(f"Wishlist already exists for user with Telegram ID: {tg_id}")
@@ -29,6 +60,9 @@ async def set_wishlist(tg_id):
 
 
 async def get_fragrance_by_name(name):
+    # Imported on first use to keep fuzzywuzzy off the startup path
+    from fuzzywuzzy import process
+
     async with async_session() as session:
         fragrances = await session.execute(select(Fragrance.name))
         fragrance_names = [fragrance[0] for fragrance in fragrances.fetchall()]
@@ -44,13 +78,15 @@ async def get_fragrance_by_name(name):
 async def add_fragrance_to_wishlist(telegram_id, fragrance_name):
     async with async_session() as session:
         try:
-            wishlist = await session.scalar(select(Wishlist).where(Wishlist.telegram_id == telegram_id))
-            fragrance = await session.scalar(select(Fragrance).where(Fragrance.name == fragrance_name))
+            wishlist_id = await session.scalar(select(Wishlist.id).where(Wishlist.telegram_id == telegram_id))
+            fragrance_id = await session.scalar(select(Fragrance.id).where(Fragrance.name == fragrance_name))
 
-            if fragrance:
-                if fragrance not in wishlist.fragrances:
-                    wishlist.fragrances.append(fragrance)
-                    await session.commit()
+            if fragrance_id:
+                result = await session.execute(
+                    insert_ignore(wishlist_fragrance).values(wishlist_id=wishlist_id, fragrance_id=fragrance_id)
+                )
+                await session.commit()
+                if result.rowcount:
                     logger.info(
                         f"Added fragrance '{fragrance_name}' to wishlist for user with Telegram ID: {telegram_id}")
                     return True
@@ -71,7 +107,11 @@ async def add_fragrance_to_wishlist(telegram_id, fragrance_name):
 async def get_wishlist_by_telegram_id(telegram_id):
     async with async_session() as session:
         try:
-            wishlist = await session.scalar(select(Wishlist).where(Wishlist.telegram_id == telegram_id))
+            wishlist = await session.scalar(
+                select(Wishlist)
+                .where(Wishlist.telegram_id == telegram_id)
+                .options(selectinload(Wishlist.fragrances).selectinload(Fragrance.variants))
+            )
             return wishlist
         except Exception as e:
             logger.error(f"Error retrieving wishlist: {e}")
@@ -137,41 +177,293 @@ async def toggle_notification_status_in_db(telegram_id):
             return None
 
 
-async def get_users_by_fragrance(fragrance):
+async def get_all_users():
+    async with async_session() as session:
+        try:
+            result = await session.execute(select(Wishlist.telegram_id))
+            all_users = [row[0] for row in result.all()]
+            return all_users
+        except Exception as e:
+            logger.error(f"Error retrieving all users: {e}")
+            return []
+
+
+async def get_due_outbox_events(limit=10):
     async with async_session() as session:
         try:
-            users = await session.execute(
-                select(Wishlist.telegram_id)
-                .join(Wishlist.fragrances)
-                .where(Fragrance.id == fragrance.id)
-                .where(Wishlist.receive_notification == True)
+            now = now_almaty()
+            events = await session.scalars(
+                select(OutboxEvent)
+                .where(OutboxEvent.completed_at.is_(None))
+                .where(OutboxEvent.available_at <= now)
+                .where(or_(OutboxEvent.claimed_until.is_(None), OutboxEvent.claimed_until < now))
+                .order_by(OutboxEvent.id)
+                .limit(limit)
             )
-            users = [row[0] for row in users.all()]
-            return users
+            return list(events)
         except Exception as e:
-            logger.error(f"Error retrieving notification status: {e}")
+            logger.error(f"Error retrieving due outbox events: {e}")
+            return []
+
+
+async def claim_outbox_event(event_id, owner, lease_seconds):
+    """Takes a lease on the event for `owner` so only one notifier works on it at a time."""
+    async with async_session() as session:
+        now = now_almaty()
+        result = await session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id == event_id)
+            .where(OutboxEvent.completed_at.is_(None))
+            .where(or_(OutboxEvent.claimed_until.is_(None), OutboxEvent.claimed_until < now))
+            .values(claimed_until=now + timedelta(seconds=lease_seconds), claimed_by=owner)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def extend_outbox_claim(event_id, owner, lease_seconds):
+    """Renews the lease; returns False if it expired and another notifier has taken the event."""
+    async with async_session() as session:
+        result = await session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id == event_id, OutboxEvent.claimed_by == owner)
+            .where(OutboxEvent.completed_at.is_(None))
+            .values(claimed_until=now_almaty() + timedelta(seconds=lease_seconds))
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+def outbox_recipients(event):
+    if event.audience == "user":
+        return select(literal(event.id), literal(event.telegram_id)).where(literal(event.telegram_id).is_not(None))
+
+    query = select(literal(event.id), Wishlist.telegram_id).where(Wishlist.receive_notification == True)
+    if event.audience == "all":
+        # Users with subscription rules only hear about what their rules match
+        query = query.where(~exists().where(SubscriptionRule.telegram_id == Wishlist.telegram_id))
+    if event.audience == "wishlist":
+        query = query.join(Wishlist.fragrances).where(Fragrance.id == event.fragrance_id)
+    if event.exclude_telegram_id is not None:
+        query = query.where(Wishlist.telegram_id != event.exclude_telegram_id)
+    return query
+
+
+async def expand_outbox_event(event):
+    """Freezes the recipient list of the event into one pending delivery per user.
+
+    Re-running it after a crash adds nothing, deliveries are keyed by (event, user).
+    """
+    async with async_session() as session:
+        await session.execute(
+            insert_ignore(Delivery).from_select([Delivery.event_id, Delivery.telegram_id], outbox_recipients(event))
+        )
+        # Rule matches were added by the scraper, drop the ones who have turned notifications off since
+        await session.execute(
+            update(Delivery)
+            .where(Delivery.event_id == event.id, Delivery.status == "pending")
+            .where(Delivery.telegram_id.in_(
+                select(Wishlist.telegram_id).where(Wishlist.receive_notification == False)))
+            .values(status="skipped")
+        )
+        await session.execute(
+            update(OutboxEvent).where(OutboxEvent.id == event.id).values(expanded_at=now_almaty())
+        )
+        await session.commit()
+
+
+async def get_pending_deliveries(event_id, limit):
+    async with async_session() as session:
+        result = await session.execute(
+            select(Delivery.telegram_id, Delivery.attempts)
+            .where(Delivery.event_id == event_id, Delivery.status == "pending")
+            .order_by(Delivery.attempts, Delivery.telegram_id)
+            .limit(limit)
+        )
+        return result.all()
+
+
+async def count_pending_deliveries(event_id):
+    async with async_session() as session:
+        return await session.scalar(
+            select(func.count()).where(Delivery.event_id == event_id, Delivery.status == "pending"))
+
+
+async def record_deliveries(event_id, sent, failed, retry):
+    """Marks a batch of deliveries as sent, failed for good, or due for another attempt."""
+    async with async_session() as session:
+        if sent:
+            await session.execute(
+                update(Delivery)
+                .where(Delivery.event_id == event_id, Delivery.telegram_id.in_(sent))
+                .values(status="sent", attempts=Delivery.attempts + 1, sent_at=now_almaty())
+            )
+        if failed:
+            await session.execute(
+                update(Delivery)
+                .where(Delivery.event_id == event_id, Delivery.telegram_id.in_(failed))
+                .values(status="failed", attempts=Delivery.attempts + 1)
+            )
+        if retry:
+            await session.execute(
+                update(Delivery)
+                .where(Delivery.event_id == event_id, Delivery.telegram_id.in_(retry))
+                .values(attempts=Delivery.attempts + 1)
+            )
+        await session.commit()
+
+
+async def complete_outbox_event(event_id, owner):
+    async with async_session() as session:
+        result = await session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id == event_id, OutboxEvent.claimed_by == owner)
+            .values(completed_at=now_almaty(), claimed_until=None)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def purge_outbox(completed_before):
+    """Deletes events completed before `completed_before` with their deliveries; returns how many events."""
+    async with async_session() as session:
+        completed = select(OutboxEvent.id).where(OutboxEvent.completed_at < completed_before)
+        await session.execute(delete(Delivery).where(Delivery.event_id.in_(completed)))
+        result = await session.execute(delete(OutboxEvent).where(OutboxEvent.completed_at < completed_before))
+        await session.commit()
+        return result.rowcount
+
+
+async def add_stock_history(entries):
+    async with async_session() as session:
+        session.add_all([StockHistory(**entry) for entry in entries])
+        await session.commit()
+
+
+async def get_subscription_rules(telegram_id):
+    async with async_session() as session:
+        try:
+            return list(await session.scalars(
+                select(SubscriptionRule)
+                .where(SubscriptionRule.telegram_id == telegram_id)
+                .order_by(SubscriptionRule.id)
+            ))
+        except Exception as e:
+            logger.error(f"Error retrieving subscription rules: {e}")
+            return []
+
+
+async def get_all_subscription_rules():
+    """Every rule, for the matching index. Errors propagate: an empty list would mean nobody has rules."""
+    async with async_session() as session:
+        return list(await session.scalars(select(SubscriptionRule).order_by(SubscriptionRule.id)))
+
+
+async def add_subscription_rule(telegram_id, kind, pattern=""):
+    async with async_session() as session:
+        try:
+            result = await session.execute(
+                insert_ignore(SubscriptionRule).values(telegram_id=telegram_id, kind=kind, pattern=pattern,
+                                                       created_at=now_almaty())
+            )
+            await session.commit()
+            if result.rowcount:
+                logger.info(f"Added {kind} rule '{pattern}' for user with Telegram ID: {telegram_id}")
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"Error adding subscription rule: {e}")
+            await session.rollback()
             return None
 
 
-async def get_all_wishlists():
+async def delete_subscription_rule(telegram_id, rule_id):
+    """Deletes one of the user's rules and returns it, or None if there was no such rule."""
     async with async_session() as session:
         try:
-            users = await session.execute(
-                select(Wishlist.telegram_id).where(Wishlist.receive_notification == True)
+            rule = await session.scalar(
+                select(SubscriptionRule)
+                .where(SubscriptionRule.id == rule_id, SubscriptionRule.telegram_id == telegram_id)
             )
-            users = [row[0] for row in users.all()]
-            return users
+            if rule:
+                await session.execute(delete(SubscriptionRule).where(SubscriptionRule.id == rule_id))
+                await session.commit()
+            return rule
         except Exception as e:
-            logger.error(f"Error retrieving users with notifications: {e}")
+            logger.error(f"Error deleting subscription rule: {e}")
+            await session.rollback()
             return None
 
 
-async def get_all_users():
+async def get_detail_crawl_targets(changed_ids, stale_before, limit):
+    """Products whose listing entry just changed, then ones never crawled, then the most out of date."""
     async with async_session() as session:
         try:
-            result = await session.execute(select(Wishlist.telegram_id))
-            all_users = [row[0] for row in result.all()]
-            return all_users
+            result = await session.execute(
+                select(Fragrance.id, Fragrance.url, Fragrance.etag, Fragrance.last_modified)
+                .where(Fragrance.url.is_not(None))
+                .where(or_(Fragrance.id.in_(changed_ids),
+                           Fragrance.details_crawled_at.is_(None),
+                           Fragrance.details_crawled_at < stale_before))
+                .order_by(Fragrance.id.in_(changed_ids).desc(), Fragrance.details_crawled_at.nulls_first())
+                .limit(limit)
+            )
+            return result.all()
         except Exception as e:
-            logger.error(f"Error retrieving all users: {e}")
-            return []
\ No newline at end of file
+            logger.error(f"Error retrieving detail crawl targets: {e}")
+            return []
+
+
+async def save_detail_pages(pages, restock_events=None):
+    """Stores crawled variant stock; returns `(fragrance name, variant name)` for each size back in stock.
+
+    `restock_events(fragrance, variant name)` builds the outbox events for a size that came back
+    while other sizes were in stock; they are written in the same transaction as the stock.
+    When every size was sold out, the listing page reports the restock of the whole fragrance.
+    """
+    restocked = []
+    async with async_session() as session:
+        try:
+            fragrances = await session.scalars(
+                select(Fragrance)
+                .where(Fragrance.id.in_([page.fragrance_id for page in pages]))
+                .options(selectinload(Fragrance.variants))
+            )
+            pages_by_id = {page.fragrance_id: page for page in pages}
+            now = now_almaty()
+            for fragrance in fragrances:
+                page = pages_by_id[fragrance.id]
+                fragrance.details_crawled_at = now
+                if page.not_modified:
+                    continue
+                if not page.variants:
+                    # Likely a layout change or a broken page; keep the known sizes and refetch it in full next time
+                    logger.warning(f"No variants found on the product page of {fragrance.name}, keeping stored ones")
+                    continue
+                fragrance.etag = page.etag
+                fragrance.last_modified = page.last_modified
+
+                current = {variant.name: variant for variant in fragrance.variants}
+                was_available = any(not variant.is_sold_out for variant in current.values())
+                crawled = dict(page.variants)
+                for name, is_sold_out in crawled.items():
+                    variant = current.get(name)
+                    if variant is None:
+                        fragrance.variants.append(
+                            FragranceVariant(name=name, is_sold_out=is_sold_out, updated_at=now))
+                    elif variant.is_sold_out != is_sold_out:
+                        if not is_sold_out:
+                            restocked.append((fragrance.name, name))
+                            if was_available and restock_events is not None:
+                                session.add_all(restock_events(fragrance, name))
+                        variant.is_sold_out = is_sold_out
+                        variant.updated_at = now
+                for name, variant in current.items():
+                    if name not in crawled:
+                        fragrance.variants.remove(variant)
+            await session.commit()
+        except Exception as e:
+            logger.error(f"Error saving detail pages: {e}")
+            await session.rollback()
+            return []
+    return restocked
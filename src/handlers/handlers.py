@@ -2,50 +2,60 @@ import asyncio
 import logging
 import time
 
-import redis.asyncio as redis
-from aiogram import Router, F, Bot
+from aiogram import Router, F
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.filters import CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 
 import src.keyboards.keyboards as kb
-from config import config
-from config.base import getenv
+from redis.asyncio import Redis
+
 from src.database import requests
 from src.database.requests import (
     get_fragrance_by_name, add_fragrance_to_wishlist, get_wishlist_by_telegram_id,
     delete_fragrance_from_wishlist, get_notification_status_by_telegram_id,
-    toggle_notification_status_in_db, get_users_by_fragrance, get_all_wishlists, get_all_users
+    toggle_notification_status_in_db
 )
-from src.states.states import AddToWishlist, AdminMessage
+from src.middlewares.middlewares import BackpressureMiddleware, MetricsMiddleware, ProfilingMiddleware
+from src.services import cache, profiling, runtime_settings, subscriptions
+from src.services.notifications import send_message_to_all_users, send_photo_to_all_users
+from src.states.states import AddToWishlist, AddSubscription, AdminMessage
 
 TELEGRAM_MESSAGE_LIMIT = 4096
 
-config.setup_logging()
 logger = logging.getLogger(__name__)
 
 router: Router = Router()
-redis_client = redis.Redis(host='localhost', port=6381, db=0)
+# Shared by both observers so the in-flight bound covers every update
+backpressure = BackpressureMiddleware()
+router.message.middleware(backpressure)
+router.callback_query.middleware(backpressure)
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(MetricsMiddleware())
+router.message.middleware(ProfilingMiddleware())
+router.callback_query.middleware(ProfilingMiddleware())
 
 COOLDOWN_PERIOD = 3  # Cooldown period in seconds
 
+broadcasts = set()  # Running admin broadcasts, referenced so they are not garbage collected
+
 
 def cooldown_key(user_id, action):
     return f"cooldown_{action}_{user_id}"
 
 
-async def check_cooldown(user_id, action):
-    last_interaction_time = await redis_client.get(cooldown_key(user_id, action))
+async def check_cooldown(redis: Redis, user_id, action):
+    last_interaction_time = await redis.get(cooldown_key(user_id, action))
     current_time = time.time()
     if last_interaction_time is not None and (current_time - float(last_interaction_time)) < COOLDOWN_PERIOD:
         return True
-    await redis_client.set(cooldown_key(user_id, action), current_time)
+    await redis.set(cooldown_key(user_id, action), current_time)
     return False
 
 
 @router.message(CommandStart())
 async def process_any_message(message: Message):
-    is_admin = str(message.from_user.id) == getenv("ADMIN_USER_ID")
+    is_admin = runtime_settings.is_admin(message.from_user.id)
     await requests.set_wishlist(tg_id=message.from_user.id)
     await message.answer(text="Welcome to Montagne Parfums fragrance tracker!",
                          reply_markup=kb.get_main_keyboard(is_admin))
@@ -54,14 +64,30 @@ async def process_any_message(message: Message):
 @router.message(F.text == "◀️ Back to menu")
 async def menu(message: Message, state: FSMContext):
     await state.clear()
-    is_admin = str(message.from_user.id) == getenv("ADMIN_USER_ID")
+    is_admin = runtime_settings.is_admin(message.from_user.id)
     await message.answer(text="Main menu", reply_markup=kb.get_main_keyboard(is_admin))
 
 
+@router.message(Command("profile"))
+async def start_profiling(message: Message, command: CommandObject):
+    if not runtime_settings.is_admin(message.from_user.id):
+        await message.answer("You do not have permission to use this feature.")
+        return
+
+    args = (command.args or "").split()
+    if not args or args[0] not in profiling.remaining or (len(args) > 1 and not args[1].isdigit()):
+        await message.answer(f"Usage: /profile {'|'.join(profiling.remaining)} [count]")
+        return
+
+    count = int(args[1]) if len(args) > 1 else 1
+    profiling.arm(args[0], count)
+    await message.answer(f"Profiling the next {count} {args[0]} calls, results go to logs/.")
+
+
 @router.message(F.text == "📄 Wishlist")
-async def show_wishlist(message: Message):
+async def show_wishlist(message: Message, redis: Redis):
     user_id = message.from_user.id
-    if await check_cooldown(user_id, "wishlist"):
+    if await check_cooldown(redis, user_id, "wishlist"):
         await message.answer("Please wait before requesting the wishlist again.")
         return
 
@@ -79,8 +105,10 @@ async def show_wishlist(message: Message):
                         [InlineKeyboardButton(
                             text="Delete",
                             callback_data=f"_{fragrance.name[:60] if len(fragrance.name) > 60 else fragrance.name}")]])
-                await message.answer(text=f"{status_symbol} {fragrance.name.title()}",
-                                     reply_markup=delete_from_wishlist)
+                text = f"{status_symbol} {fragrance.name.title()}"
+                for variant in fragrance.variants:
+                    text += f"\n    {'✅' if not variant.is_sold_out else '❌'} {variant.name.lower()}"
+                await message.answer(text=text, reply_markup=delete_from_wishlist)
 
         await message.answer(text="If you want to add a new fragrance, press \"Add fragrance to wishlist\" below",
                              reply_markup=kb.add_to_wishlist)
@@ -91,9 +119,9 @@ async def show_wishlist(message: Message):
 
 
 @router.message(F.text == "➕ Add fragrance to wishlist")
-async def type_fragrance(message: Message, state: FSMContext):
+async def type_fragrance(message: Message, state: FSMContext, redis: Redis):
     user_id = message.from_user.id
-    if await check_cooldown(user_id, "add_wishlist"):
+    if await check_cooldown(redis, user_id, "add_wishlist"):
         await message.answer("Please wait before requesting again.")
         return
 
@@ -147,15 +175,15 @@ async def delete(callback: CallbackQuery):
         await callback.answer(text="An error occurred while deleting the fragrance", show_alert=True)
 
 
-@router.message(F.text == "🔍 Fragrances")
-async def all_fragrances(message: Message):
+@router.message(F.text == "🔍 Fragrances", flags={"heavy": True})
+async def all_fragrances(message: Message, redis: Redis):
     user_id = message.from_user.id
-    if await check_cooldown(user_id, "fragrances"):
+    if await check_cooldown(redis, user_id, "fragrances"):
         await message.answer("Please wait before requesting the list of fragrances again.")
         return
 
     try:
-        fragrances = await requests.get_all_fragrances()
+        fragrances = await cache.get_all_fragrances(redis)
 
         current_message = ""
         max_length = 4096
@@ -180,23 +208,103 @@ async def all_fragrances(message: Message):
         await message.answer("An error occurred while showing all fragrances. Please try again later.")
 
 
+SUBSCRIPTIONS_TEXT = ("Get notified when a new or restocked fragrance matches a keyword or starts with a brand.\n"
+                      "Without subscriptions you hear about every new fragrance, with them only about matches. "
+                      "Turn on \"Anything new\" to keep getting everything.")
+
+
+@router.message(F.text == "🔔 Subscriptions")
+async def show_subscriptions(message: Message, redis: Redis):
+    user_id = message.from_user.id
+    if await check_cooldown(redis, user_id, "subscriptions"):
+        await message.answer("Please wait before requesting your subscriptions again.")
+        return
+
+    rules = await requests.get_subscription_rules(user_id)
+    await message.answer(text=SUBSCRIPTIONS_TEXT, reply_markup=kb.get_subscriptions_keyboard(rules))
+
+
+@router.callback_query(F.data.startswith("sub_add_"))
+async def type_subscription(callback: CallbackQuery, state: FSMContext):
+    kind = callback.data.removeprefix("sub_add_")
+    if kind not in subscriptions.PATTERN_KINDS:
+        await callback.answer(text="Unknown subscription type", show_alert=True)
+        return
+
+    await state.set_state(AddSubscription.adding)
+    await state.update_data(kind=kind)
+    await callback.answer()
+    await callback.message.answer(text=f"Type the {kind} you want to follow", reply_markup=kb.back_to_menu)
+
+
+@router.message(AddSubscription.adding)
+async def add_subscription(message: Message, state: FSMContext, redis: Redis):
+    kind = (await state.get_data()).get("kind")
+    if kind not in subscriptions.PATTERN_KINDS:
+        kind = subscriptions.KEYWORD
+    pattern = subscriptions.normalize_pattern(message.text or "")
+    if not subscriptions.MIN_PATTERN_LENGTH <= len(pattern) <= subscriptions.MAX_PATTERN_LENGTH:
+        await message.answer(f"Please type between {subscriptions.MIN_PATTERN_LENGTH} and "
+                             f"{subscriptions.MAX_PATTERN_LENGTH} characters.")
+        return
+
+    await state.clear()
+    result = await subscriptions.add_rule(redis, message.from_user.id, kind, pattern)
+    if result is None:
+        await message.answer("An error occurred while saving your subscription. Please try again later.")
+        return
+
+    is_admin = runtime_settings.is_admin(message.from_user.id)
+    text = f"Subscribed to {kind} {pattern.title()}!" if result else f"You already follow {kind} {pattern.title()}."
+    await message.answer(text=text, reply_markup=kb.get_main_keyboard(is_admin))
+    rules = await requests.get_subscription_rules(message.from_user.id)
+    await message.answer(text=SUBSCRIPTIONS_TEXT, reply_markup=kb.get_subscriptions_keyboard(rules))
+
+
+@router.callback_query(F.data.startswith("sub_del_"))
+async def delete_subscription(callback: CallbackQuery, redis: Redis):
+    rule_id = callback.data.removeprefix("sub_del_")
+    if not rule_id.isdecimal():
+        await callback.answer(text="Subscription not found", show_alert=True)
+        return
+
+    telegram_id = callback.from_user.id
+    rule = await subscriptions.remove_rule(redis, telegram_id, int(rule_id))
+    if rule is None:
+        await callback.answer(text="Subscription not found", show_alert=True)
+        return
+
+    rules = await requests.get_subscription_rules(telegram_id)
+    await callback.message.edit_reply_markup(reply_markup=kb.get_subscriptions_keyboard(rules))
+    await callback.answer(text=f"Unsubscribed from {rule.pattern.title()}")
+
+
+@router.callback_query(F.data == "sub_toggle_new")
+async def toggle_anything_new(callback: CallbackQuery, redis: Redis):
+    telegram_id = callback.from_user.id
+    rules = await requests.get_subscription_rules(telegram_id)
+    anything_new = next((rule for rule in rules if rule.kind == subscriptions.ANYTHING_NEW), None)
+    if anything_new:
+        await subscriptions.remove_rule(redis, telegram_id, anything_new.id)
+    else:
+        await subscriptions.add_rule(redis, telegram_id, subscriptions.ANYTHING_NEW)
+
+    rules = await requests.get_subscription_rules(telegram_id)
+    await callback.message.edit_reply_markup(reply_markup=kb.get_subscriptions_keyboard(rules))
+    await callback.answer()
+
+
 @router.message(F.text == "⚙️ Settings")
-async def settings(message: Message):
+async def settings(message: Message, redis: Redis):
     user_id = message.from_user.id
-    is_admin = str(user_id) == getenv("ADMIN_USER_ID")
+    is_admin = runtime_settings.is_admin(user_id)
 
-    if await check_cooldown(user_id, "settings"):
+    if await check_cooldown(redis, user_id, "settings"):
         await message.answer("Please wait before requesting the settings again.")
         return
 
     try:
         notification_status = await get_notification_status_by_telegram_id(user_id)
-        admin_prioritize_status = await redis_client.get("is_admin_prioritize")
-        admin_prioritize_status = admin_prioritize_status.decode()
-
-        # Default to 'False' if the value is not set
-        if admin_prioritize_status not in ["True", "False"]:
-            admin_prioritize_status = "False"
 
         if notification_status is not None:
             status_text = "On" if notification_status else "Off"
@@ -206,7 +314,7 @@ async def settings(message: Message):
             )
 
             if is_admin:
-                admin_prioritize_text = "On" if admin_prioritize_status == "True" else "Off"
+                admin_prioritize_text = "On" if runtime_settings.current.admin_prioritize else "Off"
                 admin_prioritize_keyboard = InlineKeyboardMarkup(
                     inline_keyboard=[[InlineKeyboardButton(text=f"Admin Prioritize: {admin_prioritize_text}",
                                                            callback_data="toggle_admin_prioritize")]]
@@ -243,23 +351,18 @@ async def toggle_notification_status(callback_query: CallbackQuery):
 
 
 @router.callback_query(F.data == "toggle_admin_prioritize")
-async def toggle_admin_prioritize(callback_query: CallbackQuery):
+async def toggle_admin_prioritize(callback_query: CallbackQuery, redis: Redis):
     user_id = callback_query.from_user.id
-    is_admin = str(user_id) == getenv("ADMIN_USER_ID")
+    is_admin = runtime_settings.is_admin(user_id)
     if not is_admin:
         await callback_query.answer("You are not authorized to use this feature.")
         return
 
-    current_status = await redis_client.get("is_admin_prioritize")
-    if current_status is None:
-        current_status = "False"  # Default to False if not set
-    else:
-        current_status = current_status.decode()
-    new_status = "False" if current_status == "True" else "True"
-    await redis_client.set("is_admin_prioritize", new_status)
-    logger.info(f"Admin Prioritize status changed from {current_status} to {new_status}")
+    new_status = not runtime_settings.current.admin_prioritize
+    await runtime_settings.set_admin_prioritize(redis, new_status)
+    logger.info(f"Admin Prioritize status changed to {new_status}")
 
-    status_text = "On" if new_status == "True" else "Off"
+    status_text = "On" if new_status else "Off"
     await callback_query.message.edit_reply_markup(
         reply_markup=InlineKeyboardMarkup(
             inline_keyboard=[[InlineKeyboardButton(text=f"Admin Prioritize: {status_text}",
@@ -269,155 +372,9 @@ async def toggle_admin_prioritize(callback_query: CallbackQuery):
     await callback_query.answer("Admin prioritize status updated.")
 
 
-async def send_notification(bot: Bot, fragrance, priority_queue=False, second_try=False):
-    try:
-        users = await get_users_by_fragrance(fragrance)
-        if priority_queue:
-            # Notify the admin user immediately
-            admin_user_id = getenv("ADMIN_USER_ID")
-            await bot.send_photo(
-                chat_id=admin_user_id,
-                photo=fragrance.image_url,
-                caption=f"The fragrance {fragrance.name} is now available!"
-            )
-            return
-
-        if second_try:
-            admin_user_id = int(getenv("ADMIN_USER_ID"))
-            if admin_user_id in users:
-                users.remove(int(admin_user_id))  # Remove admin from the list for later notifications
-
-        async def send_batch(batch, retries=3):
-            for attempt in range(retries):
-                tasks = [bot.send_photo(
-                    chat_id=user_id,
-                    photo=fragrance.image_url,
-                    caption=f"The fragrance {fragrance.name} is now available!"
-                ) for user_id in batch]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                failed_users = []
-                for user_id, result in zip(batch, results):
-                    if isinstance(result, Exception):
-                        logger.error(f"Attempt {attempt + 1} failed for user {user_id}: {result}")
-                        failed_users.append(user_id)
-
-                if not failed_users:
-                    break
-
-                batch = failed_users
-            else:
-                for user_id in batch:
-                    logger.error(f"Failed to send notification to user {user_id} after {retries} attempts")
-
-        batch_size = 50
-        for i in range(0, len(users), batch_size):
-            batch = users[i:i + batch_size]
-            await send_batch(batch)
-            await asyncio.sleep(1)
-
-    except Exception as e:
-        logger.error(f"Error sending notification: {e}")
-
-
-async def send_notification_new_fragrance(bot: Bot, fragrance):
-    try:
-        users = await get_all_wishlists()
-
-        async def send_batch(batch, retries=3):
-            for attempt in range(retries):
-                tasks = [bot.send_photo(
-                    chat_id=user_id,
-                    photo=fragrance.image_url,
-                    caption=f"New fragrance is at the store! Check out {fragrance.name}!"
-                ) for user_id in batch]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                failed_users = []
-                for user_id, result in zip(batch, results):
-                    if isinstance(result, Exception):
-                        logger.error(f"Attempt {attempt + 1} failed for user {user_id}: {result}")
-                        failed_users.append(user_id)
-
-                if not failed_users:
-                    break
-
-                batch = failed_users
-            else:
-                for user_id in batch:
-                    logger.error(f"Failed to send notification to user {user_id} after {retries} attempts")
-
-        batch_size = 50
-        for i in range(0, len(users), batch_size):
-            batch = users[i:i + batch_size]
-            await send_batch(batch)
-            await asyncio.sleep(1)
-
-    except Exception as e:
-        logger.error(f"Error sending notification: {e}")
-
-
-async def send_message_to_all_users(bot, message_text):
-    users = await get_all_users()  # Implement this function to get all user IDs
-
-    async def send_batch(batch, retries=3):
-        for attempt in range(retries):
-            tasks = [bot.send_message(chat_id=user_id, text=message_text) for user_id in batch]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            failed_users = []
-            for user_id, result in zip(batch, results):
-                if isinstance(result, Exception):
-                    logger.error(f"Attempt {attempt + 1} failed for user {user_id}: {result}")
-                    failed_users.append(user_id)
-
-            if not failed_users:
-                break
-
-            batch = failed_users
-        else:
-            for user_id in batch:
-                logger.error(f"Failed to send message to user {user_id} after {retries} attempts")
-
-    batch_size = 50
-    for i in range(0, len(users), batch_size):
-        batch = users[i:i + batch_size]
-        await send_batch(batch)
-        await asyncio.sleep(1)  # Add a delay between batches to avoid rate limiting
-
-
-async def send_photo_to_all_users(bot, photo_file_id, caption=None):
-    users = await get_all_users()  # Implement this function to get all user IDs
-
-    async def send_batch(batch, retries=3):
-        for attempt in range(retries):
-            tasks = [bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=caption) for user_id in batch]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            failed_users = []
-            for user_id, result in zip(batch, results):
-                if isinstance(result, Exception):
-                    logger.error(f"Attempt {attempt + 1} failed for user {user_id}: {result}")
-                    failed_users.append(user_id)
-
-            if not failed_users:
-                break
-
-            batch = failed_users
-        else:
-            for user_id in batch:
-                logger.error(f"Failed to send photo to user {user_id} after {retries} attempts")
-
-    batch_size = 50
-    for i in range(0, len(users), batch_size):
-        batch = users[i:i + batch_size]
-        await send_batch(batch)
-        await asyncio.sleep(1)  # Add a delay between batches to avoid rate limiting
-
-
 @router.message(F.text == "👨🏻‍💼 Admin")
 async def admin_button_pressed(message: Message, state: FSMContext):
-    if str(message.from_user.id) == getenv("ADMIN_USER_ID"):
+    if runtime_settings.is_admin(message.from_user.id):
         await message.answer("Please enter the message you want to send to all users.", reply_markup=kb.back_to_menu)
         await state.set_state(AdminMessage.typing_message)
     else:
@@ -433,11 +390,26 @@ async def send_admin_message(message: Message, state: FSMContext):
         if message.photo:
             photo = message.photo[-1]  # Get the largest photo
             photo_file_id = photo.file_id
-            await send_photo_to_all_users(message.bot, photo_file_id, text)
+            broadcast = send_photo_to_all_users(message.bot, photo_file_id, text)
         else:
-            await send_message_to_all_users(message.bot, text)
+            broadcast = send_message_to_all_users(message.bot, text)
     else:
         await message.answer("Only text and photo messages are supported.")
         return
 
-    await message.answer("Your message has been sent to all users.")
+    # The fan-out takes minutes, run it in the background so the admin's other taps are not queued behind it
+    task = asyncio.create_task(run_broadcast(message, broadcast))
+    broadcasts.add(task)
+    task.add_done_callback(broadcasts.discard)
+    await message.answer("Your message is being sent to all users.")
+
+
+async def run_broadcast(message: Message, broadcast):
+    try:
+        # Holds a heavy slot for the whole fan-out, so broadcasts queue behind cheap handlers
+        async with backpressure.slot(heavy=True):
+            await broadcast
+        await message.answer("Your message has been sent to all users.")
+    except Exception as e:
+        logger.error(f"Error broadcasting admin message: {e}")
+        await message.answer("An error occurred while sending your message to all users.")
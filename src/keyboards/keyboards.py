@@ -1,10 +1,12 @@
 from aiogram.types import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton
 
+from src.services.subscriptions import KEYWORD, BRAND, ANYTHING_NEW
+
 
 def get_main_keyboard(is_admin):
     keyboard = [
         [KeyboardButton(text="📄 Wishlist"), KeyboardButton(text="🔍 Fragrances")],
-        [KeyboardButton(text="⚙️ Settings")]
+        [KeyboardButton(text="🔔 Subscriptions"), KeyboardButton(text="⚙️ Settings")]
     ]
     if is_admin:
         keyboard.append([KeyboardButton(text="👨🏻‍💼 Admin")])
@@ -22,3 +24,15 @@ add_to_wishlist = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="➕ Add fr
 add_more = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="➕Add more", callback_data="add_more")]])
 
 back_to_menu = ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="◀️ Back to menu")]], resize_keyboard=True)
+
+
+def get_subscriptions_keyboard(rules):
+    labels = {KEYWORD: "Keyword", BRAND: "Brand"}
+    keyboard = [[InlineKeyboardButton(text=f"❌ {labels[rule.kind]}: {rule.pattern.title()}",
+                                      callback_data=f"sub_del_{rule.id}")]
+                for rule in rules if rule.kind in labels]
+    anything_new = "On" if any(rule.kind == ANYTHING_NEW for rule in rules) else "Off"
+    keyboard.append([InlineKeyboardButton(text="➕ Keyword", callback_data=f"sub_add_{KEYWORD}"),
+                     InlineKeyboardButton(text="➕ Brand", callback_data=f"sub_add_{BRAND}")])
+    keyboard.append([InlineKeyboardButton(text=f"Anything new: {anything_new}", callback_data="sub_toggle_new")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject
+
+from src.services import profiling
+from src.services.metrics import (
+    HANDLER_SECONDS, HANDLER_QUEUE_SECONDS, HANDLERS_IN_FLIGHT, UPDATES_COALESCED, timed
+)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Observes the latency of every matched handler, labelled by its function name."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        with timed(HANDLER_SECONDS, handler=name):
+            return await handler(event, data)
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """Profiles handler calls while `/profile handlers N` is armed and passes straight through otherwise."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not profiling.remaining[profiling.HANDLERS]:
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        return await profiling.profile(profiling.HANDLERS, name, handler(event, data))
+
+
+class PrioritySemaphore:
+    """A semaphore that hands a freed slot to the waiter with the lowest `priority` first."""
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # The slot was handed over just before the cancellation
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+@dataclass
+class UserQueue:
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    size: int = 0
+
+
+class UserQueueMiddleware(BaseMiddleware):
+    """Runs each user's updates one at a time and drops bursts beyond `per_user_limit`.
+
+    Registered on the dispatcher's updates ahead of the FSM middleware, so the FSM state is
+    read inside the lock and one user's steps cannot race each other.
+    """
+
+    def __init__(self, per_user_limit=3):
+        self.per_user_limit = per_user_limit
+        self.users: Dict[int, UserQueue] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        data["queued_at"] = time.perf_counter()
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        queue = self.users.setdefault(user.id, UserQueue())
+        if queue.size >= self.per_user_limit:
+            UPDATES_COALESCED.inc()
+            callback_query = getattr(event, "callback_query", None)
+            message = getattr(event, "message", None)
+            if callback_query is not None:
+                # Otherwise the client keeps showing a spinner on the button
+                await data["bot"].answer_callback_query(callback_query.id, text="Please wait a moment.")
+            elif message is not None:
+                # Otherwise what the user typed, e.g. a fragrance name, silently disappears
+                await data["bot"].send_message(chat_id=message.chat.id,
+                                               text="Please wait a moment and send that again.")
+            return None
+        queue.size += 1
+        try:
+            async with queue.lock:
+                return await handler(event, data)
+        finally:
+            queue.size -= 1
+            if not queue.size:
+                del self.users[user.id]
+
+
+class BackpressureMiddleware(BaseMiddleware):
+    """Bounds the number of handlers running at once.
+
+    Handlers flagged `heavy` get at most `max_heavy` of the slots and wait behind cheap ones.
+    Work started outside a handler, such as an admin broadcast, takes a slot with `slot()`.
+    Queue wait is measured from when `UserQueueMiddleware` first saw the update.
+    """
+
+    def __init__(self, max_in_flight=32, max_heavy=8):
+        self.slots = PrioritySemaphore(max_in_flight)
+        self.heavy_slots = asyncio.Semaphore(max_heavy)
+
+    @asynccontextmanager
+    async def slot(self, heavy=False, started=None):
+        priority = "heavy" if heavy else "cheap"
+        started = started if started is not None else time.perf_counter()
+        if heavy:
+            await self.heavy_slots.acquire()
+        try:
+            await self.slots.acquire(int(heavy))
+            HANDLER_QUEUE_SECONDS.labels(priority=priority).observe(time.perf_counter() - started)
+            HANDLERS_IN_FLIGHT.inc()
+            try:
+                yield
+            finally:
+                HANDLERS_IN_FLIGHT.dec()
+                self.slots.release()
+        finally:
+            if heavy:
+                self.heavy_slots.release()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with self.slot(heavy=bool(get_flag(data, "heavy")), started=data.get("queued_at")):
+            return await handler(event, data)
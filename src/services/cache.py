@@ -0,0 +1,39 @@
+import json
+import logging
+
+from redis.asyncio import Redis
+
+from src.database import requests
+
+logger = logging.getLogger(__name__)
+
+FRAGRANCES_CACHE_KEY = "cache:fragrances"
+# Bumped on every invalidation. A reader that loaded from the database before the bump
+# writes under the old generation, so its stale copy is never served.
+FRAGRANCES_GENERATION_KEY = "cache:fragrances:generation"
+FRAGRANCES_CACHE_TTL = 600  # Safety net in case an invalidation event is lost
+
+
+async def get_all_fragrances(redis: Redis):
+    """The `(name, is_sold_out)` list, served from Redis until a change event invalidates it."""
+    key = None
+    try:
+        key = f"{FRAGRANCES_CACHE_KEY}:{int(await redis.get(FRAGRANCES_GENERATION_KEY) or 0)}"
+        cached = await redis.get(key)
+        if cached is not None:
+            return [tuple(row) for row in json.loads(cached)]
+    except Exception as e:
+        logger.error(f"Error reading the fragrance cache: {e}")
+
+    fragrances = await requests.get_all_fragrances()
+    if fragrances is not None and key is not None:
+        try:
+            await redis.set(key, json.dumps([list(row) for row in fragrances]),
+                            ex=FRAGRANCES_CACHE_TTL)
+        except Exception as e:
+            logger.error(f"Error writing the fragrance cache: {e}")
+    return fragrances
+
+
+async def invalidate_fragrances(redis: Redis):
+    await redis.incr(FRAGRANCES_GENERATION_KEY)
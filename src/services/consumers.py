@@ -0,0 +1,104 @@
+"""Consumer groups reading the scraper's change events.
+
+They run inside the bot process by default. To scale one out, run it on its own:
+
+    $ python -m src.services.consumers analytics --metrics-port 8001
+"""
+import argparse
+import asyncio
+import logging
+
+from aiogram import Bot
+from redis.asyncio import Redis
+
+from config import config, load_config
+from src.database import requests
+from src.database.models import create_engine_from_config, create_session_factory
+from src.database.requests import add_stock_history
+from src.services import metrics
+from src.services.cache import invalidate_fragrances
+from src.services.events import consume
+from src.services.notifications import run_notifier, wake_notifier
+
+logger = logging.getLogger(__name__)
+
+NOTIFIER_GROUP = "notifier"
+CACHE_GROUP = "cache"
+ANALYTICS_GROUP = "analytics"
+
+
+async def wake_notifier_handler(events):
+    # The outbox rows were committed with the change, the event only wakes the notifier up early.
+    # Sending stays in run_notifier so each process drains the outbox from a single loop.
+    wake_notifier()
+
+
+def cache_handler(redis: Redis):
+    async def handle(events):
+        await invalidate_fragrances(redis)
+    return handle
+
+
+async def record_history(events):
+    await add_stock_history([
+        {"fragrance_id": event.fragrance_id, "event": event.type, "occurred_at": event.occurred_at}
+        for event in events
+    ])
+
+
+def consumer_handlers(redis: Redis):
+    return {
+        NOTIFIER_GROUP: wake_notifier_handler,
+        CACHE_GROUP: cache_handler(redis),
+        ANALYTICS_GROUP: record_history,
+    }
+
+
+def start_consumers(redis: Redis, groups=None):
+    """Starts one task per consumer group and returns them."""
+    handlers = consumer_handlers(redis)
+    return [
+        asyncio.create_task(consume(redis, group, handlers[group]), name=group)
+        for group in (groups or handlers)
+    ]
+
+
+async def run(groups, metrics_port=None):
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+
+    settings = load_config()
+    metrics.start_metrics_server(settings.metrics.host, metrics_port or settings.metrics.consumers_port)
+    engine = create_engine_from_config(settings.database)
+    metrics.instrument_engine(engine)
+    requests.bind(engine, create_session_factory(engine))
+    redis = metrics.InstrumentedRedis(host=settings.redis.host, port=settings.redis.port, db=settings.redis.db)
+    bot = Bot(token=settings.tg_bot.token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    tasks = start_consumers(redis, groups)
+    if NOTIFIER_GROUP in groups:
+        # The notifier group only wakes the notifier, which has to run in this process as well
+        tasks.append(asyncio.create_task(run_notifier(bot)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await bot.session.close()
+        await redis.aclose()
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run change-event consumers outside the bot process.")
+    parser.add_argument("groups", nargs="+", choices=[NOTIFIER_GROUP, CACHE_GROUP, ANALYTICS_GROUP])
+    parser.add_argument("--metrics-port", type=int,
+                        help="Port for /metrics (default: CONSUMERS_METRICS_PORT)")
+    args = parser.parse_args()
+
+    config.setup_logging()
+    try:
+        asyncio.run(run(args.groups, args.metrics_port))
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Consumers stopped")
+
+
+if __name__ == "__main__":
+    main()
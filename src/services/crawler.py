@@ -0,0 +1,133 @@
+"""Bounded, polite crawler for product detail pages.
+
+Pages are fetched with a fixed number of concurrent requests, at most `HOST_RATE` request
+starts per second per host, and conditional headers so unchanged pages come back as 304.
+"""
+import asyncio
+import html
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from config import config
+from src.services.metrics import DETAIL_FETCHES
+
+logger = logging.getLogger(__name__)
+
+DETAIL_CONCURRENCY = 8
+HOST_RATE = 4  # Request starts per second per host
+DETAIL_TIMEOUT = 15  # Seconds per page
+
+# Squarespace keeps the variant list of a product as JSON in this attribute
+VARIANTS_PATTERN = re.compile(r'data-variants="([^"]*)"')
+
+
+@dataclass
+class CrawlTarget:
+    fragrance_id: int
+    url: str
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+@dataclass
+class DetailPage:
+    fragrance_id: int
+    not_modified: bool = False
+    etag: str | None = None
+    last_modified: str | None = None
+    variants: list[tuple[str, bool]] = field(default_factory=list)
+
+
+def parse_variants(page):
+    """Returns `(NAME, is_sold_out)` for each variant on the product page."""
+    match = VARIANTS_PATTERN.search(page)
+    if not match:
+        return []
+
+    variants = []
+    for variant in json.loads(html.unescape(match.group(1))):
+        attributes = variant.get("attributes") or {}
+        name = " / ".join(str(value) for value in attributes.values()).strip().upper() or "ONE SIZE"
+        in_stock = variant.get("unlimited") or (variant.get("qtyInStock") or 0) > 0
+        variants.append((name, not in_stock))
+    return variants
+
+
+class HostRateLimiter:
+    """Spaces request starts to the same host at least `1 / rate` seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_start = {}
+
+    async def wait(self, host):
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start.get(host, now))
+        self.next_start[host] = start + self.interval
+        await asyncio.sleep(start - now)
+
+
+async def fetch_detail(http: aiohttp.ClientSession, target: CrawlTarget, headers):
+    headers = dict(headers)
+    if target.etag:
+        headers["If-None-Match"] = target.etag
+    if target.last_modified:
+        headers["If-Modified-Since"] = target.last_modified
+
+    async with http.get(target.url, headers=headers, timeout=aiohttp.ClientTimeout(total=DETAIL_TIMEOUT)) as response:
+        if response.status == 304:
+            return DetailPage(target.fragrance_id, not_modified=True)
+        response.raise_for_status()
+        return DetailPage(
+            target.fragrance_id,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            variants=parse_variants(await response.text()),
+        )
+
+
+async def crawl(http: aiohttp.ClientSession, targets, headers, deadline):
+    """Fetches the detail pages of `targets` and returns the pages fetched before `deadline` (loop time).
+
+    Fetches still running at the deadline are cancelled, those products are picked up next cycle.
+    """
+    if not targets:
+        return []
+
+    semaphore = asyncio.Semaphore(DETAIL_CONCURRENCY)
+    limiter = HostRateLimiter(HOST_RATE)
+
+    async def fetch(target):
+        async with semaphore:
+            await limiter.wait(urlsplit(target.url).netloc)
+            return await fetch_detail(http, target, headers)
+
+    tasks = [asyncio.create_task(fetch(target)) for target in targets]
+    timeout = max(0.0, deadline - asyncio.get_running_loop().time())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    DETAIL_FETCHES.labels(result="skipped").inc(len(pending))
+
+    pages = []
+    for target, task in zip(targets, tasks):
+        if task not in done:
+            continue
+        if task.exception() is not None:
+            DETAIL_FETCHES.labels(result="error").inc()
+            config.log_event(logger, logging.WARNING, "detail_fetch_failed", sample_key="detail_fetch_failed",
+                             url=target.url, error=type(task.exception()).__name__)
+            continue
+        page = task.result()
+        DETAIL_FETCHES.labels(result="not_modified" if page.not_modified else "ok").inc()
+        pages.append(page)
+
+    if pending:
+        logger.warning(f"Detail crawl hit its deadline, {len(pending)} of {len(targets)} pages left for next cycle")
+    return pages
@@ -0,0 +1,194 @@
+"""Typed change events published by the scraper on a Redis Stream.
+
+Each consumer reads the stream through its own consumer group, so it keeps its own
+position, lag and acknowledgements and can run in any number of processes.
+
+Events are published after the scrape transaction commits and are not retried. If the
+process dies in between, or Redis is down, the change is recorded in the database but
+never reaches the stream. Notifications do not depend on it (they go through the outbox)
+and the fragrance cache expires on its own, but `stock_history` misses those changes.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+
+from redis.asyncio import Redis
+
+from src.database.models import now_almaty
+from src.services.metrics import EVENTS_PUBLISHED, STREAM_LAG, STREAM_PENDING
+
+logger = logging.getLogger(__name__)
+
+STREAM = "fragrance:changes"
+STREAM_MAXLEN = 100_000
+CONSUMER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+CLAIM_IDLE_MS = 60_000  # Entries left unacked this long by a dead consumer are taken over
+MAX_DELIVERIES = 5  # Entries a group fails to handle this many times go to the dead-letter stream
+DEAD_LETTER_STREAM = f"{STREAM}:dead"
+DEAD_LETTER_MAXLEN = 10_000
+RETRY_DELAY = 1  # Seconds to wait after a failed batch before reading again
+
+ADDED = "added"
+RESTOCKED = "restocked"
+SOLD_OUT = "sold_out"
+
+
+@dataclass(frozen=True)
+class FragranceEvent:
+    type: str
+    fragrance_id: int
+    name: str
+    image_url: str
+    is_sold_out: bool
+    occurred_at: datetime
+
+    @classmethod
+    def from_fragrance(cls, event_type, fragrance):
+        return cls(type=event_type, fragrance_id=fragrance.id, name=fragrance.name, image_url=fragrance.image_url,
+                   is_sold_out=fragrance.is_sold_out, occurred_at=now_almaty())
+
+    def to_fields(self):
+        fields = asdict(self)
+        fields["is_sold_out"] = int(self.is_sold_out)
+        fields["occurred_at"] = self.occurred_at.isoformat()
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields):
+        fields = {key.decode(): value.decode() for key, value in fields.items()}
+        return cls(
+            type=fields["type"],
+            fragrance_id=int(fields["fragrance_id"]),
+            name=fields["name"],
+            image_url=fields["image_url"],
+            is_sold_out=fields["is_sold_out"] == "1",
+            occurred_at=datetime.fromisoformat(fields["occurred_at"]),
+        )
+
+
+async def publish_events(redis: Redis, events):
+    if not events:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for event in events:
+            pipe.xadd(STREAM, event.to_fields(), maxlen=STREAM_MAXLEN, approximate=True)
+        await pipe.execute()
+    for event in events:
+        EVENTS_PUBLISHED.labels(type=event.type).inc()
+
+
+async def ensure_group(redis: Redis, group):
+    try:
+        await redis.xgroup_create(STREAM, group, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def update_lag(redis: Redis):
+    for info in await redis.xinfo_groups(STREAM):
+        group = info["name"].decode() if isinstance(info["name"], bytes) else info["name"]
+        STREAM_PENDING.labels(group=group).set(info.get("pending") or 0)
+        if info.get("lag") is not None:
+            STREAM_LAG.labels(group=group).set(info["lag"])
+
+
+async def claim_stale(redis: Redis, group, count):
+    """Takes over entries a dead consumer left unacked; returns True if any were claimed."""
+    _, claimed, *_ = await redis.xautoclaim(STREAM, group, CONSUMER_NAME, min_idle_time=CLAIM_IDLE_MS,
+                                            start_id="0-0", count=count)
+    if claimed:
+        logger.info(f"Claimed {len(claimed)} stale {STREAM} entries for {group}")
+    await remove_idle_consumers(redis, group)
+    return bool(claimed)
+
+
+async def remove_idle_consumers(redis: Redis, group):
+    """Deletes consumers left behind by earlier processes once they have nothing pending.
+
+    `CONSUMER_NAME` includes the pid, so every restart adds a consumer to each group. A live
+    consumer reads at least every `block_ms`, so one idle for `CLAIM_IDLE_MS` is gone.
+    """
+    for consumer in await redis.xinfo_consumers(STREAM, group):
+        name = consumer["name"].decode() if isinstance(consumer["name"], bytes) else consumer["name"]
+        if name == CONSUMER_NAME or consumer["pending"] or consumer["idle"] < CLAIM_IDLE_MS:
+            continue
+        await redis.xgroup_delconsumer(STREAM, group, name)
+        logger.info(f"Removed idle consumer {name} from {group}")
+
+
+async def retire_exhausted(redis: Redis, group, handler, entries):
+    """Settles entries of a failed batch that have been delivered `MAX_DELIVERIES` times.
+
+    Each gets one last try on its own, so a single bad entry does not take the rest of its
+    batch down with it. Entries that still fail are copied to `DEAD_LETTER_STREAM` and
+    acknowledged, so the group moves on.
+    """
+    # A batch is a contiguous run of this consumer's pending entries, in stream order
+    pending = await redis.xpending_range(STREAM, group, min=entries[0][0], max=entries[-1][0],
+                                         count=len(entries), consumername=CONSUMER_NAME)
+    exhausted = {entry["message_id"] for entry in pending if entry["times_delivered"] >= MAX_DELIVERIES}
+    for entry_id, fields in entries:
+        # Trimmed entries have no fields and are acked with the next batch that succeeds
+        if entry_id not in exhausted or not fields:
+            continue
+        try:
+            await handler([FragranceEvent.from_fields(fields)])
+        except Exception as e:
+            logger.error(f"Moving {STREAM} entry {entry_id} to {DEAD_LETTER_STREAM} after {MAX_DELIVERIES} "
+                         f"failed deliveries to {group}: {e}")
+            await redis.xadd(DEAD_LETTER_STREAM, {**fields, "group": group, "entry_id": entry_id, "error": str(e)},
+                             maxlen=DEAD_LETTER_MAXLEN, approximate=True)
+        await redis.xack(STREAM, group, entry_id)
+
+
+async def consume(redis: Redis, group, handler, count=100, block_ms=5000):
+    """Feeds batches of events to `handler` and acknowledges them once it returns.
+
+    A batch whose handler raises stays pending and is delivered again, until its entries
+    have been delivered `MAX_DELIVERIES` times and are retired by `retire_exhausted`.
+    Entries left pending by a dead consumer are claimed at startup and then every `CLAIM_IDLE_MS`,
+    and consumers of earlier processes are removed once they have nothing pending.
+    """
+    await ensure_group(redis, group)
+    await claim_stale(redis, group, count)
+    claimed_at = time.monotonic()
+    last_id = "0"  # Drain entries this consumer already owns before reading new ones
+
+    while True:
+        entries = []
+        try:
+            response = await redis.xreadgroup(group, CONSUMER_NAME, {STREAM: last_id}, count=count, block=block_ms)
+            entries = response[0][1] if response else []
+            if not entries:
+                last_id = ">"
+                if time.monotonic() - claimed_at >= CLAIM_IDLE_MS / 1000:
+                    claimed_at = time.monotonic()
+                    if await claim_stale(redis, group, count):
+                        last_id = "0"
+                await update_lag(redis)
+                continue
+
+            # Pending entries trimmed from the stream come back without fields, there is nothing to handle
+            events = [FragranceEvent.from_fields(fields) for _, fields in entries if fields]
+            if len(events) < len(entries):
+                logger.warning(f"Skipping {len(entries) - len(events)} trimmed {STREAM} entries for {group}")
+            if events:
+                await handler(events)
+            await redis.xack(STREAM, group, *[entry_id for entry_id, _ in entries if entry_id])
+            await update_lag(redis)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error consuming {STREAM} as {group}: {e}")
+            last_id = "0"
+            if entries:
+                try:
+                    await retire_exhausted(redis, group, handler, entries)
+                except Exception as e:
+                    logger.error(f"Error retiring failed {STREAM} entries for {group}: {e}")
+            await asyncio.sleep(RETRY_DELAY)
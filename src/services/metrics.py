@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+
+import redis.asyncio as redis
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+registered = []
+
+
+class LazyMetric:
+    """Stands in for a prometheus_client metric and creates it on first use.
+
+    Importing prometheus_client is one of the larger costs of starting the bot, and nothing
+    is recorded before the event loop runs, so the import waits until then.
+    """
+
+    def __init__(self, kind, *args, **kwargs):
+        self._kind = kind
+        self._args = args
+        self._kwargs = kwargs
+        self._metric = None
+        registered.append(self)
+
+    def create(self):
+        if self._metric is None:
+            import prometheus_client
+            self._metric = getattr(prometheus_client, self._kind)(*self._args, **self._kwargs)
+        return self._metric
+
+    def __getattr__(self, name):
+        return getattr(self.create(), name)
+
+
+SCRAPE_STAGE_SECONDS = LazyMetric(
+    "Histogram", "scrape_stage_seconds", "Duration of update_fragrances stages.", ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180),
+)
+HANDLER_SECONDS = LazyMetric(
+    "Histogram", "handler_seconds", "Latency of aiogram handlers.", ["handler"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+HANDLER_QUEUE_SECONDS = LazyMetric(
+    "Histogram", "handler_queue_seconds",
+    "Time from receiving an update until its handler starts, including the wait behind the same user.", ["priority"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+HANDLERS_IN_FLIGHT = LazyMetric("Gauge", "handlers_in_flight", "Handlers currently running.")
+UPDATES_COALESCED = LazyMetric(
+    "Counter", "updates_coalesced_total", "Updates dropped because the user already had enough queued."
+)
+SEND_QUEUE_DEPTH = LazyMetric("Gauge", "send_queue_depth", "Recipients still waiting in running fan-outs.")
+NOTIFICATION_SECONDS = LazyMetric(
+    "Histogram", "notification_seconds", "Time from writing an outbox event to its last delivery.", ["kind"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+SENDS_TOTAL = LazyMetric("Counter", "telegram_sends_total", "Telegram send calls by result.", ["result"])
+TELEGRAM_ERRORS = LazyMetric("Counter", "telegram_errors_total", "Failed Telegram calls by exception class.", ["error"])
+REDIS_SECONDS = LazyMetric(
+    "Histogram", "redis_command_seconds", "Redis command latency.", ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+DB_SECONDS = LazyMetric(
+    "Histogram", "db_statement_seconds", "Database statement latency.", ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1),
+)
+DETAIL_FETCHES = LazyMetric("Counter", "detail_fetches_total", "Product detail page fetches by result.", ["result"])
+EVENTS_PUBLISHED = LazyMetric(
+    "Counter", "stream_events_published_total", "Change events published by the scraper.", ["type"]
+)
+STREAM_LAG = LazyMetric("Gauge", "stream_group_lag", "Entries not yet delivered to a consumer group.", ["group"])
+STREAM_PENDING = LazyMetric(
+    "Gauge", "stream_group_pending", "Entries delivered to a consumer group but not acknowledged.", ["group"]
+)
+EVENT_LOOP_LAG_SECONDS = LazyMetric(
+    "Histogram", "event_loop_lag_seconds", "How late the event loop wakes up a sleeping task.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+
+@contextmanager
+def timed(histogram: LazyMetric, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        (histogram.labels(**labels) if labels else histogram).observe(elapsed)
+
+
+def record_send_results(results):
+    """Counts the outcome of a gathered batch of Telegram calls."""
+    for result in results:
+        if isinstance(result, Exception):
+            SENDS_TOTAL.labels(result="error").inc()
+            TELEGRAM_ERRORS.labels(error=type(result).__name__).inc()
+        else:
+            SENDS_TOTAL.labels(result="ok").inc()
+
+
+class InstrumentedRedis(redis.Redis):
+    async def execute_command(self, *args, **options):
+        with timed(REDIS_SECONDS, command=str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Times every statement the engine executes."""
+    sync_engine = engine.sync_engine
+
+    # The start time lives on the statement's execution context, which is dropped with the
+    # statement, so a statement that raises and never reaches after_cursor_execute leaves nothing behind
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "query_started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        DB_SECONDS.labels(statement=statement.lstrip().split(" ", 1)[0].upper()).observe(elapsed)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+def start_metrics_server(host: str, port: int):
+    """Serves all metrics in Prometheus text format from a background thread.
+
+    Metrics are not worth failing startup for: when the port cannot be bound, the error is
+    logged and the process runs without them. Returns whether the server started.
+    """
+    from prometheus_client import start_http_server
+
+    # Unlabelled metrics show up in the first scrape even if nothing has recorded them yet
+    for metric in registered:
+        metric.create()
+    try:
+        start_http_server(port, addr=host)
+    except OSError as e:
+        logger.error(f"Could not serve metrics on {host}:{port}, running without them: {e}")
+        return False
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return True
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import uuid
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from config import config
+from src.database.models import as_almaty, now_almaty, OutboxEvent, Delivery
+from src.database.requests import (
+    get_all_users, get_due_outbox_events, claim_outbox_event, extend_outbox_claim, expand_outbox_event,
+    get_pending_deliveries, count_pending_deliveries, record_deliveries, complete_outbox_event, purge_outbox
+)
+from src.services.metrics import SEND_QUEUE_DEPTH, NOTIFICATION_SECONDS, record_send_results
+
+logger = logging.getLogger(__name__)
+
+SEND_BATCH_SIZE = 50
+SEND_BATCH_DELAY = 1  # Delay between batches in seconds to avoid rate limiting
+MAX_DELIVERY_ATTEMPTS = 3
+NOTIFIER_POLL_INTERVAL = 2  # Seconds between outbox polls when there is nothing to send
+# Seconds an event stays claimed by one notifier without progress. Must outlast one batch:
+# the Bot session's 60 s request timeout plus SEND_BATCH_DELAY.
+NOTIFIER_LEASE = 120
+OUTBOX_RETENTION = timedelta(days=7)  # Completed events and their deliveries are kept this long
+
+RESTOCK = "restock"
+VARIANT_RESTOCK = "variant_restock"
+NEW_FRAGRANCE = "new_fragrance"
+
+CAPTIONS = {
+    RESTOCK: "The fragrance {name} is now available!",
+    VARIANT_RESTOCK: "The {variant} size of {name} is back in stock!",
+    NEW_FRAGRANCE: "New fragrance is at the store! Check out {name}!",
+}
+
+
+def rule_deliveries(subscribers, exclude_telegram_id=None):
+    """Pending deliveries for users matched by subscription rules; expansion adds the rest of the audience."""
+    return [Delivery(telegram_id=telegram_id) for telegram_id in sorted(subscribers)
+            if telegram_id != exclude_telegram_id]
+
+
+def restock_events(fragrance, admin_user_id=None, admin_prioritize=False, subscribers=(), variant=None):
+    """Outbox events announcing that `fragrance`, or only its `variant` size, is back in stock.
+
+    With admin prioritize on, the admin is told right away and everyone else five minutes later.
+    """
+    kind = VARIANT_RESTOCK if variant else RESTOCK
+    if admin_prioritize and admin_user_id is not None:
+        return [
+            OutboxEvent(kind=kind, fragrance=fragrance, variant=variant, audience="user", telegram_id=admin_user_id),
+            OutboxEvent(kind=kind, fragrance=fragrance, variant=variant, audience="wishlist",
+                        exclude_telegram_id=admin_user_id, available_at=now_almaty() + timedelta(minutes=5),
+                        deliveries=rule_deliveries(subscribers, exclude_telegram_id=admin_user_id)),
+        ]
+    return [OutboxEvent(kind=kind, fragrance=fragrance, variant=variant, audience="wishlist",
+                        deliveries=rule_deliveries(subscribers))]
+
+
+def new_fragrance_events(fragrance, subscribers=()):
+    return [OutboxEvent(kind=NEW_FRAGRANCE, fragrance=fragrance, audience="all",
+                        deliveries=rule_deliveries(subscribers))]
+
+
+async def deliver_outbox_event(bot: Bot, event: OutboxEvent, owner):
+    """Sends the event's pending deliveries; returns False if the lease was lost to another notifier."""
+    caption = CAPTIONS[event.kind].format(name=event.fragrance.name, variant=(event.variant or "").lower())
+    # Counted once per event, then tracked in memory as batches finish
+    remaining = await count_pending_deliveries(event.id)
+    SEND_QUEUE_DEPTH.inc(remaining)
+
+    try:
+        while True:
+            pending = await get_pending_deliveries(event.id, SEND_BATCH_SIZE)
+            if not pending:
+                break
+
+            users = [telegram_id for telegram_id, _ in pending]
+            tasks = [bot.send_photo(chat_id=user_id, photo=event.fragrance.image_url, caption=caption)
+                     for user_id in users]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            record_send_results(results)
+
+            sent, failed, retry = [], [], []
+            retry_after = 0
+            for (user_id, attempts), result in zip(pending, results):
+                if not isinstance(result, Exception):
+                    sent.append(user_id)
+                    continue
+
+                config.log_event(logger, logging.WARNING, "send_failed", sample_key="send_failed",
+                                 attempt=attempts + 1, user_id=user_id, error=type(result).__name__,
+                                 detail=str(result))
+                if isinstance(result, TelegramRetryAfter):
+                    # Flood control only delays the delivery, it stays pending without using up an attempt
+                    retry_after = max(retry_after, result.retry_after)
+                    continue
+                permanent = isinstance(result, (TelegramForbiddenError, TelegramBadRequest))
+                if permanent or attempts + 1 >= MAX_DELIVERY_ATTEMPTS:
+                    config.log_event(logger, logging.ERROR, "send_gave_up", sample_key="send_gave_up",
+                                     kind=event.kind, user_id=user_id, attempts=attempts + 1)
+                    failed.append(user_id)
+                else:
+                    retry.append(user_id)
+
+            await record_deliveries(event.id, sent, failed, retry)
+            remaining -= len(sent) + len(failed)
+            SEND_QUEUE_DEPTH.dec(len(sent) + len(failed))
+
+            # The lease has to cover the wait as well as the next batch
+            delay = max(SEND_BATCH_DELAY, retry_after)
+            if not await extend_outbox_claim(event.id, owner, delay + NOTIFIER_LEASE):
+                logger.warning(f"Lost the claim on outbox event {event.id}, leaving it to the notifier that took it")
+                return False
+            await asyncio.sleep(delay)
+        return True
+    finally:
+        SEND_QUEUE_DEPTH.dec(remaining)
+
+
+async def process_outbox(bot: Bot):
+    """Sends every due outbox event and returns how many were handled."""
+    handled = 0
+    for event in await get_due_outbox_events():
+        owner = uuid.uuid4().hex  # Per claim, so even two drainers in one process can tell their claims apart
+        if not await claim_outbox_event(event.id, owner, NOTIFIER_LEASE):
+            continue  # Another notifier took it
+        if event.expanded_at is None:
+            await expand_outbox_event(event)
+        if not await deliver_outbox_event(bot, event, owner) or not await complete_outbox_event(event.id, owner):
+            continue
+        NOTIFICATION_SECONDS.labels(kind=event.kind).observe(
+            (now_almaty() - as_almaty(event.created_at)).total_seconds())
+        logger.info(f"Outbox event {event.id} ({event.kind} {event.fragrance.name}) delivered")
+        handled += 1
+    return handled
+
+
+outbox_changed = asyncio.Event()
+
+
+def wake_notifier():
+    """Makes `run_notifier` poll right away instead of at the end of its interval."""
+    outbox_changed.set()
+
+
+async def run_notifier(bot: Bot):
+    """Drains the notification outbox until cancelled."""
+    while True:
+        outbox_changed.clear()
+        try:
+            handled = await process_outbox(bot)
+        except Exception as e:
+            logger.error(f"Error processing notification outbox: {e}")
+            handled = 0
+        if not handled:
+            try:
+                await asyncio.wait_for(outbox_changed.wait(), NOTIFIER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def purge_delivered():
+    """Deletes outbox events completed more than `OUTBOX_RETENTION` ago, run by the scheduler."""
+    try:
+        purged = await purge_outbox(now_almaty() - OUTBOX_RETENTION)
+        if purged:
+            logger.info(f"Purged {purged} completed outbox events")
+    except Exception as e:
+        logger.error(f"Error purging the notification outbox: {e}")
+
+
+async def send_message_to_all_users(bot, message_text):
+    users = await get_all_users()  # Implement this function to get all user IDs
+
+    async def send_batch(batch, retries=3):
+        for attempt in range(retries):
+            tasks = [bot.send_message(chat_id=user_id, text=message_text) for user_id in batch]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            record_send_results(results)
+
+            failed_users = []
+            for user_id, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    config.log_event(logger, logging.WARNING, "send_failed", sample_key="send_failed",
+                                     attempt=attempt + 1, user_id=user_id, error=type(result).__name__,
+                                     detail=str(result))
+                    failed_users.append(user_id)
+
+            if not failed_users:
+                break
+
+            batch = failed_users
+        else:
+            for user_id in batch:
+                config.log_event(logger, logging.ERROR, "send_gave_up", sample_key="send_gave_up",
+                                 kind="message", user_id=user_id, attempts=retries)
+
+    SEND_QUEUE_DEPTH.inc(len(users))
+    batch_size = SEND_BATCH_SIZE
+    for i in range(0, len(users), batch_size):
+        batch = users[i:i + batch_size]
+        await send_batch(batch)
+        SEND_QUEUE_DEPTH.dec(len(batch))
+        await asyncio.sleep(SEND_BATCH_DELAY)
+
+
+async def send_photo_to_all_users(bot, photo_file_id, caption=None):
+    users = await get_all_users()  # Implement this function to get all user IDs
+
+    async def send_batch(batch, retries=3):
+        for attempt in range(retries):
+            tasks = [bot.send_photo(chat_id=user_id, photo=photo_file_id, caption=caption) for user_id in batch]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            record_send_results(results)
+
+            failed_users = []
+            for user_id, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    config.log_event(logger, logging.WARNING, "send_failed", sample_key="send_failed",
+                                     attempt=attempt + 1, user_id=user_id, error=type(result).__name__,
+                                     detail=str(result))
+                    failed_users.append(user_id)
+
+            if not failed_users:
+                break
+
+            batch = failed_users
+        else:
+            for user_id in batch:
+                config.log_event(logger, logging.ERROR, "send_gave_up", sample_key="send_gave_up",
+                                 kind="photo", user_id=user_id, attempts=retries)
+
+    SEND_QUEUE_DEPTH.inc(len(users))
+    batch_size = SEND_BATCH_SIZE
+    for i in range(0, len(users), batch_size):
+        batch = users[i:i + batch_size]
+        await send_batch(batch)
+        SEND_QUEUE_DEPTH.dec(len(batch))
+        await asyncio.sleep(SEND_BATCH_DELAY)
@@ -1,27 +1,21 @@
 import asyncio
-import os
-from datetime import datetime
-from logging.handlers import RotatingFileHandler
-from zoneinfo import ZoneInfo
+from datetime import timedelta
+from urllib.parse import urljoin
 
 import aiohttp
-from aiogram import Bot
-from aiogram.types import Message
-from bs4 import BeautifulSoup
 import logging
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import sessionmaker
-from src.database.models import Fragrance, engine
-from config import config
-from src.handlers.handlers import redis_client
-
-config.setup_logging()
+from redis.asyncio import Redis
+from redis.exceptions import LockError
+from sqlalchemy import select, update
+from src.database.models import Fragrance, now_almaty
+from src.database.requests import async_session, get_detail_crawl_targets, insert_ignore, save_detail_pages
+from src.services import crawler, profiling, runtime_settings, subscriptions
+from src.services.events import FragranceEvent, ADDED, RESTOCKED, SOLD_OUT, publish_events
+from src.services.metrics import SCRAPE_STAGE_SECONDS, timed
+from src.services.notifications import restock_events, new_fragrance_events
+
 logger = logging.getLogger(__name__)
 logger_new_fragrance = logging.getLogger("new_fragrance")
-new_fragrance_handler = RotatingFileHandler(os.path.join('logs', 'new_fragrance.log'), maxBytes=1024 * 1024, backupCount=5)
-new_fragrance_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger_new_fragrance.addHandler(new_fragrance_handler)
 
 MONTAGNE_URL = "https://www.montagneparfums.com/fragrance"
 HEADERS = {
@@ -32,65 +26,202 @@ HEADERS = {
     "Accept-Language": "en-US,en;q=0.9,ru;q=0.8"
 }
 
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+CYCLE_BUDGET = 150  # Seconds a cycle may take, leaves headroom in the 3 minute schedule
+LISTING_TIMEOUT = 30  # Seconds for the listing page, well inside the cycle budget
+DETAIL_TTL = timedelta(hours=6)  # Unchanged products are re-crawled this often
+MAX_DETAILS_PER_CYCLE = 200
+SCRAPE_LOCK_KEY = "lock:scrape"
+# Seconds; renewed between stages, expires by the next scheduled cycle if the holder dies mid-scrape
+SCRAPE_LOCK_TIMEOUT = 180
 
 
-async def update_fragrances(message: Message, bot: Bot):
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(MONTAGNE_URL, headers=HEADERS) as response:
+def parse_products(html):
+    # bs4 and lxml are only needed once the first scrape runs, keep them off the startup path
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "lxml")
+    parsed = []
+    for product in soup.findAll("div", class_="ProductList-item"):
+        product_name = product.find('h1').text.strip() if product.find('h1') else None
+        product_image_link = product.find('img')['data-src']
+        link = product.find('a', href=True)
+        product_url = urljoin(MONTAGNE_URL, link['href']) if link else None
+
+        if product_name:
+            sold_out_marker = product.find('div', class_='product-mark sold-out')
+            parsed.append((product_name.upper(), product_image_link, bool(sold_out_marker), product_url))
+    return parsed
+
+
+def variant_restock_events(fragrance, variant_name):
+    return restock_events(
+        fragrance,
+        admin_user_id=runtime_settings.current.admin_user_id,
+        admin_prioritize=runtime_settings.current.admin_prioritize,
+        variant=variant_name,
+    )
+
+
+async def update_details(http: aiohttp.ClientSession, changed_ids, deadline):
+    """Crawls product pages for per-size stock, changed products first, and stops at `deadline`.
+
+    A size coming back in stock is written to the outbox for the fragrance's wishlist holders.
+    """
+    targets = [crawler.CrawlTarget(*row) for row in
+               await get_detail_crawl_targets(changed_ids, now_almaty() - DETAIL_TTL, MAX_DETAILS_PER_CYCLE)]
+    pages = await crawler.crawl(http, targets, HEADERS, deadline)
+    restocked = await save_detail_pages(pages, restock_events=variant_restock_events) if pages else []
+    for fragrance_name, variant_name in restocked:
+        logger_new_fragrance.info(f"Size {variant_name} of {fragrance_name} is back in stock")
+    logger.info(f"Crawled {len(pages)} of {len(targets)} product pages")
+
+
+async def extend_lock(lock):
+    """Restarts the scrape lock's timeout; returns False if it was lost and the cycle has to stop.
+
+    Only losing the lock to another process stops the cycle; a Redis error is logged and the
+    cycle carries on, as in `scrape`.
+    """
+    if lock is None:
+        return True
+    try:
+        await lock.extend(SCRAPE_LOCK_TIMEOUT, replace_ttl=True)
+    except LockError as e:
+        logger.error(f"Lost the scrape lock, abandoning this cycle: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Could not extend the scrape lock, continuing without it: {e}")
+    return True
+
+
+@profiling.profiled(profiling.SCRAPE)
+async def update_fragrances(redis: Redis, http: aiohttp.ClientSession, crawl_details=False, lock=None):
+    """Scrapes the catalog and records stock changes.
+
+    Notifications are written to the outbox in the same transaction and sent by the notifier;
+    every change is then published on the change-event stream. With `crawl_details`, product
+    pages are then crawled for per-size stock in whatever is left of the cycle budget.
+    `lock` is the scrape lock held by the caller, it is renewed before every stage.
+    """
+    deadline = asyncio.get_running_loop().time() + CYCLE_BUDGET
+    try:
+        with timed(SCRAPE_STAGE_SECONDS, stage="fetch"):
+            async with http.get(MONTAGNE_URL, headers=HEADERS,
+                                timeout=aiohttp.ClientTimeout(total=LISTING_TIMEOUT)) as response:
                 response.raise_for_status()
                 html = await response.text()
-        except aiohttp.ClientError as e:
-            logger.error(f"Error fetching the product page: {e}")
-            return
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Error fetching the product page: {e!r}")
+        return
+
+    with timed(SCRAPE_STAGE_SECONDS, stage="parse"):
+        products = parse_products(html)
+
+    try:
+        await subscriptions.ensure_loaded()
+    except Exception as e:
+        # Matching against no rules would leave everyone with rules out of new-fragrance notifications
+        logger.error(f"Error loading subscription rules, skipping this cycle: {e}")
+        return
+
+    if not await extend_lock(lock):
+        return
+    changes = []
+    async with async_session() as db_session:
+        with timed(SCRAPE_STAGE_SECONDS, stage="diff"):
+            for product_name_upper, product_image_link, is_sold_out, product_url in products:
+                fragrance = await db_session.scalar(select(Fragrance).where(Fragrance.name == product_name_upper))
 
-        soup = BeautifulSoup(html, "lxml")
-        products = soup.findAll("div", class_="ProductList-item")
-
-        async with async_session() as db_session:
-            for product in products:
-                product_name = product.find('h1').text.strip() if product.find('h1') else None
-                product_image_link = product.find('img')['data-src']
-
-                if product_name:
-                    product_name_upper = product_name.upper()
-                    sold_out_marker = product.find('div', class_='product-mark sold-out')
-
-                    fragrance = await db_session.scalar(select(Fragrance).where(Fragrance.name == product_name_upper))
-
-                    if fragrance:
-                        if fragrance.is_sold_out != bool(sold_out_marker):
-                            fragrance.is_sold_out = bool(sold_out_marker)
-                            fragrance.parsed_datetime = datetime.now(ZoneInfo('Asia/Almaty'))
-                            logger_new_fragrance.info(
-                                f"Updated fragrance {product_name_upper}: is_sold_out={bool(sold_out_marker)}, "
-                                f"parsed_datetime={fragrance.parsed_datetime}")
-
-                            # Retrieve the admin prioritize status
-                            is_admin_prioritize = await redis_client.get("is_admin_prioritize")
-                            from src.handlers.handlers import send_notification
-                            if is_admin_prioritize.decode() == "True":
-                                # Notify admin immediately
-                                await send_notification(bot, fragrance, priority_queue=True)
-                                # Notify other users 5 minutes later
-                                await asyncio.sleep(300)  # 5 minutes
-                                await send_notification(bot, fragrance, second_try=True)
-                            else:
-                                await send_notification(bot, fragrance)
-
-                    else:
-                        fragrance = Fragrance(name=product_name_upper, is_sold_out=bool(sold_out_marker),
-                                              image_url=product_image_link,
-                                              parsed_datetime=datetime.now(ZoneInfo('Asia/Almaty')))
-                        db_session.add(fragrance)
+                if fragrance:
+                    if product_url and fragrance.url != product_url:
+                        fragrance.url = product_url
+                    if fragrance.is_sold_out != is_sold_out:
+                        # Only flips a row still in the state read above, so if another process records
+                        # the same change first, this one matches nothing and writes no notifications
+                        flipped = await db_session.execute(
+                            update(Fragrance)
+                            .where(Fragrance.id == fragrance.id, Fragrance.is_sold_out == fragrance.is_sold_out)
+                            .values(is_sold_out=is_sold_out, parsed_datetime=now_almaty())
+                        )
+                        if flipped.rowcount != 1:
+                            continue
                         logger_new_fragrance.info(
-                            f"Added new fragrance {product_name_upper}: is_sold_out={bool(sold_out_marker)}, "
+                            f"Updated fragrance {product_name_upper}: is_sold_out={is_sold_out}, "
                             f"parsed_datetime={fragrance.parsed_datetime}")
+                        changes.append((SOLD_OUT if is_sold_out else RESTOCKED, fragrance))
 
-                        # Notify users if the new fragrance has been added
-                        from src.handlers.handlers import send_notification_new_fragrance
-                        await send_notification_new_fragrance(bot, fragrance)
+                        if not is_sold_out:
+                            db_session.add_all(restock_events(
+                                fragrance,
+                                admin_user_id=runtime_settings.current.admin_user_id,
+                                admin_prioritize=runtime_settings.current.admin_prioritize,
+                                subscribers=subscriptions.index.match(product_name_upper),
+                            ))
 
+                else:
+                    # Names are unique, the insert is skipped if another process added the fragrance first
+                    fragrance_id = await db_session.scalar(
+                        insert_ignore(Fragrance)
+                        .values(name=product_name_upper, is_sold_out=is_sold_out, image_url=product_image_link,
+                                url=product_url, parsed_datetime=now_almaty())
+                        .returning(Fragrance.id)
+                    )
+                    if fragrance_id is None:
+                        continue
+                    fragrance = await db_session.get(Fragrance, fragrance_id)
+                    logger_new_fragrance.info(
+                        f"Added new fragrance {product_name_upper}: is_sold_out={is_sold_out}, "
+                        f"parsed_datetime={fragrance.parsed_datetime}")
+                    changes.append((ADDED, fragrance))
+
+                    # Notify users if the new fragrance has been added
+                    db_session.add_all(new_fragrance_events(
+                        fragrance, subscribers=subscriptions.index.match(product_name_upper, include_new=True)))
+
+        if not await extend_lock(lock):
+            return
+        with timed(SCRAPE_STAGE_SECONDS, stage="commit"):
             await db_session.commit()
-            logger.info("Database update completed.")
+        logger.info("Database update completed.")
+
+    # Published only after the commit so consumers never see a change that was rolled back
+    try:
+        with timed(SCRAPE_STAGE_SECONDS, stage="publish"):
+            await publish_events(redis, [FragranceEvent.from_fragrance(event_type, fragrance)
+                                         for event_type, fragrance in changes])
+    except Exception as e:
+        logger.error(f"Error publishing change events: {e}")
+
+    if crawl_details and await extend_lock(lock):
+        try:
+            with timed(SCRAPE_STAGE_SECONDS, stage="details"):
+                await update_details(http, [fragrance.id for _, fragrance in changes], deadline)
+        except Exception as e:
+            logger.error(f"Error crawling product details: {e}")
+
+
+async def scrape(redis: Redis, http: aiohttp.ClientSession, crawl_details=False):
+    """Runs one scrape cycle unless another bot process is already running one.
+
+    The lock only saves duplicate work: when Redis cannot be reached the cycle runs without it,
+    since the conditional updates and insert_ignore keep concurrent cycles correct.
+    """
+    lock = redis.lock(SCRAPE_LOCK_KEY, timeout=SCRAPE_LOCK_TIMEOUT)
+    try:
+        if not await lock.acquire(blocking=False):
+            logger.info("Another process is scraping, skipping this cycle")
+            return
+    except Exception as e:
+        logger.error(f"Error taking the scrape lock, scraping without it: {e}")
+        lock = None
+
+    try:
+        await update_fragrances(redis, http, crawl_details=crawl_details, lock=lock)
+    finally:
+        if lock is not None:
+            try:
+                await lock.release()
+            except LockError:
+                logger.warning("The scrape lock expired before the cycle finished")
+            except Exception as e:
+                logger.error(f"Error releasing the scrape lock: {e}")
@@ -0,0 +1,134 @@
+"""On-demand profiling of scrape cycles and handler calls.
+
+Arm it with `/profile scrape 3` (admin only), or with PROFILE_SCRAPE_CYCLES and
+PROFILE_HANDLER_CALLS at startup. Each of the next N calls writes two files to logs/:
+- a `.folded` stack sample file for flamegraph.pl, speedscope or inferno;
+- a `.tracemalloc.txt` file listing the lines that allocated the most memory during the call.
+
+While nothing is armed, the only cost is one dict lookup per call.
+"""
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+from config.config import LOG_DIR
+
+logger = logging.getLogger(__name__)
+
+SCRAPE = "scrape"
+HANDLERS = "handlers"
+
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+TRACEMALLOC_FRAMES = 1  # Only the allocating line is reported, deeper traces multiply the overhead
+TRACEMALLOC_TOP = 30
+
+remaining = {SCRAPE: 0, HANDLERS: 0}
+_active = False
+
+
+def arm(target, count):
+    remaining[target] = max(0, count)
+    if count:
+        logger.info(f"Profiling the next {count} {target} calls")
+
+
+def is_armed(target):
+    return remaining[target] > 0
+
+
+class StackSampler:
+    """Samples the event loop thread's stack from a background thread.
+
+    Every coroutine runs on that thread, so samples taken while the profiled call awaits show
+    what else the loop was busy with, and time blocked in the selector shows up as I/O wait.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def write_allocations(path, before, after):
+    with open(path, "w") as file:
+        for stat in after.compare_to(before, "lineno")[:TRACEMALLOC_TOP]:
+            file.write(f"{stat}\n")
+
+
+async def profile(target, name, awaitable):
+    """Awaits `awaitable` under the sampler and tracemalloc, then writes the results to logs/."""
+    global _active
+    if _active or not is_armed(target):
+        # The sampler and tracemalloc are process-wide, overlapping captures would mix their data
+        return await awaitable
+
+    _active = True
+    remaining[target] -= 1
+    owns_tracemalloc = not tracemalloc.is_tracing()
+    if owns_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    before = tracemalloc.take_snapshot()
+    sampler = StackSampler()
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        elapsed = time.perf_counter() - started
+        sampler.stop()
+        after = tracemalloc.take_snapshot()
+        if owns_tracemalloc:
+            tracemalloc.stop()
+        _active = False
+
+        prefix = os.path.join(LOG_DIR, f"profile-{target}-{name}-{datetime.now():%Y%m%d-%H%M%S-%f}")
+        try:
+            sampler.write(f"{prefix}.folded")
+            write_allocations(f"{prefix}.tracemalloc.txt", before, after)
+            logger.info(f"Profiled {target} {name} in {elapsed:.3f}s: {prefix}.folded "
+                        f"({remaining[target]} {target} profiles left)")
+        except OSError as e:
+            logger.error(f"Error writing profile {prefix}: {e}")
+
+
+def profiled(target):
+    """Profiles the next armed calls of the decorated coroutine function."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not remaining[target]:
+                return await func(*args, **kwargs)
+            return await profile(target, func.__name__, func(*args, **kwargs))
+        return wrapper
+    return decorator
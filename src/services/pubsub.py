@@ -0,0 +1,30 @@
+"""Keeps process-local state in step with changes published on a Redis channel."""
+import asyncio
+import json
+import logging
+
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+
+async def watch(redis: Redis, channel, apply, reload, what):
+    """Passes every JSON message published on `channel` to `apply` until cancelled.
+
+    `reload` is awaited each time the subscription is (re)established, to pick up anything
+    changed while this process was not subscribed. Errors are logged as `Error watching
+    {what}` and the subscription is retried after a second.
+    """
+    while True:
+        try:
+            async with redis.pubsub() as subscriber:
+                await subscriber.subscribe(channel)
+                await reload()
+                async for message in subscriber.listen():
+                    if message["type"] == "message":
+                        apply(json.loads(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error watching {what}: {e}")
+            await asyncio.sleep(1)
@@ -0,0 +1,60 @@
+"""Runtime settings cached in-process.
+
+Values are read once at startup. When one changes, the change is published on a Redis
+channel, and every bot process applies it right away, so reads never hit Redis.
+"""
+import json
+import logging
+from dataclasses import dataclass
+
+from redis.asyncio import Redis
+
+from src.services import pubsub
+
+logger = logging.getLogger(__name__)
+
+ADMIN_PRIORITIZE_KEY = "is_admin_prioritize"
+SETTINGS_CHANNEL = "settings:changed"
+
+
+@dataclass
+class RuntimeSettings:
+    admin_user_id: int | None = None
+    admin_prioritize: bool = False
+
+
+current = RuntimeSettings()
+
+
+def is_admin(telegram_id):
+    return current.admin_user_id is not None and telegram_id == current.admin_user_id
+
+
+def apply(changes):
+    for name, value in changes.items():
+        if hasattr(current, name):
+            setattr(current, name, value)
+            logger.info(f"Runtime setting {name} is now {value}")
+
+
+async def load(redis: Redis, admin_user_id=None):
+    current.admin_user_id = admin_user_id
+    try:
+        current.admin_prioritize = await redis.get(ADMIN_PRIORITIZE_KEY) == b"True"
+    except Exception as e:
+        logger.error(f"Error loading runtime settings, keeping defaults: {e}")
+
+
+async def set_admin_prioritize(redis: Redis, enabled: bool):
+    # Stored in the same format as before so older deployments read it the same way
+    await redis.set(ADMIN_PRIORITIZE_KEY, str(enabled))
+    apply({"admin_prioritize": enabled})
+    await redis.publish(SETTINGS_CHANNEL, json.dumps({"admin_prioritize": enabled}))
+
+
+async def watch(redis: Redis):
+    """Applies changes published by other processes until cancelled."""
+    async def reload():
+        await load(redis, current.admin_user_id)
+
+    await pubsub.watch(redis, SETTINGS_CHANNEL, apply, reload, "runtime settings")
@@ -0,0 +1,195 @@
+"""Subscription rules and the automaton that matches product names against all of them.
+
+A rule is a keyword found anywhere in the name, a brand the name starts with, or
+"anything new". Users with at least one rule only hear about new fragrances their rules
+match; users without rules keep getting every new fragrance.
+
+Each process keeps its own index. Rule changes are published on a Redis channel so
+whichever process runs the next scrape matches against the current rules.
+"""
+import json
+import logging
+from collections import defaultdict, deque
+
+from redis.asyncio import Redis
+
+from src.database import requests
+from src.services import pubsub
+
+logger = logging.getLogger(__name__)
+
+KEYWORD = "keyword"
+BRAND = "brand"
+ANYTHING_NEW = "new"
+PATTERN_KINDS = (KEYWORD, BRAND)
+
+MIN_PATTERN_LENGTH = 2
+MAX_PATTERN_LENGTH = 100
+
+SUBSCRIPTIONS_CHANNEL = "subscriptions:changed"
+
+
+def normalize_pattern(text):
+    """Upper-cases and collapses whitespace, product names are stored the same way."""
+    return " ".join(text.split()).upper()
+
+
+class Automaton:
+    """Aho-Corasick automaton finding every occurrence of every pattern in one pass over the text."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(pattern)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text):
+        """Yields `(start, pattern)` for each match."""
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                yield end - len(pattern), pattern
+
+
+def is_word(text, start, end):
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+class SubscriptionIndex:
+    """Every user's rules, kept in memory for matching.
+
+    Rule changes only touch the subscriber sets. The automaton is rebuilt, lazily on the next
+    match, only when a pattern gains its first or loses its last subscriber.
+    """
+
+    def __init__(self):
+        self.clear()
+        self.loaded = False
+
+    def clear(self):
+        self.subscribers = {KEYWORD: defaultdict(set), BRAND: defaultdict(set)}
+        self.anything_new = set()
+        self.automaton = Automaton([])
+        self.stale = False
+
+    def load(self, rules):
+        self.clear()
+        for rule in rules:
+            self.add(rule.telegram_id, rule.kind, rule.pattern)
+        self.loaded = True
+        logger.info(f"Loaded {len(rules)} subscription rules")
+
+    def add(self, telegram_id, kind, pattern=""):
+        if kind == ANYTHING_NEW:
+            self.anything_new.add(telegram_id)
+            return
+        if kind not in PATTERN_KINDS:
+            logger.warning(f"Skipping subscription rule of unknown kind {kind!r} for {telegram_id}")
+            return
+        if pattern not in self.subscribers[KEYWORD] and pattern not in self.subscribers[BRAND]:
+            self.stale = True
+        self.subscribers[kind][pattern].add(telegram_id)
+
+    def remove(self, telegram_id, kind, pattern=""):
+        if kind == ANYTHING_NEW:
+            self.anything_new.discard(telegram_id)
+            return
+        if kind not in PATTERN_KINDS:
+            return
+        users = self.subscribers[kind].get(pattern)
+        if users is None:
+            return
+        users.discard(telegram_id)
+        if not users:
+            del self.subscribers[kind][pattern]
+            if pattern not in self.subscribers[KEYWORD] and pattern not in self.subscribers[BRAND]:
+                self.stale = True
+
+    def match(self, name, include_new=False):
+        """Telegram IDs of users whose rules match the product `name`."""
+        if self.stale:
+            self.automaton = Automaton(set(self.subscribers[KEYWORD]) | set(self.subscribers[BRAND]))
+            self.stale = False
+
+        users = set(self.anything_new) if include_new else set()
+        for start, pattern in self.automaton.find(name):
+            if not is_word(name, start, start + len(pattern)):
+                continue
+            users |= self.subscribers[KEYWORD].get(pattern, set())
+            if start == 0:
+                users |= self.subscribers[BRAND].get(pattern, set())
+        return users
+
+
+index = SubscriptionIndex()
+
+
+async def ensure_loaded():
+    """Loads the index on first use; raises if the rules cannot be read, leaving it unloaded."""
+    if not index.loaded:
+        index.load(await requests.get_all_subscription_rules())
+
+
+async def publish(redis: Redis, action, telegram_id, kind, pattern):
+    try:
+        await redis.publish(SUBSCRIPTIONS_CHANNEL, json.dumps(
+            {"action": action, "telegram_id": telegram_id, "kind": kind, "pattern": pattern}))
+    except Exception as e:
+        logger.error(f"Error publishing a subscription change, other processes pick it up on reconnect: {e}")
+
+
+def apply(change):
+    if change["action"] == "add":
+        index.add(change["telegram_id"], change["kind"], change["pattern"])
+    else:
+        index.remove(change["telegram_id"], change["kind"], change["pattern"])
+
+
+async def add_rule(redis: Redis, telegram_id, kind, pattern=""):
+    """Stores the rule and adds it to the index; returns False if the user already has it."""
+    result = await requests.add_subscription_rule(telegram_id, kind, pattern)
+    if result:
+        index.add(telegram_id, kind, pattern)
+        await publish(redis, "add", telegram_id, kind, pattern)
+    return result
+
+
+async def remove_rule(redis: Redis, telegram_id, rule_id):
+    rule = await requests.delete_subscription_rule(telegram_id, rule_id)
+    if rule:
+        index.remove(rule.telegram_id, rule.kind, rule.pattern)
+        await publish(redis, "remove", rule.telegram_id, rule.kind, rule.pattern)
+    return rule
+
+
+async def reload():
+    index.load(await requests.get_all_subscription_rules())
+
+
+async def watch(redis: Redis):
+    """Applies rule changes published by other processes until cancelled."""
+    await pubsub.watch(redis, SUBSCRIPTIONS_CHANNEL, apply, reload, "subscription rules")
@@ -6,4 +6,8 @@ class AddToWishlist(StatesGroup):
 
 
 class AdminMessage(StatesGroup):
-    typing_message = State()
\ No newline at end of file
+    typing_message = State()
+
+
+class AddSubscription(StatesGroup):
+    adding = State()
@@ -0,0 +1,133 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from src.database.models import now_almaty
+from src.services import events
+
+GROUP = "test"
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(events, "RETRY_DELAY", 0)
+
+
+def fragrance_event(name):
+    return events.FragranceEvent(type=events.ADDED, fragrance_id=1, name=name, image_url="https://example.com/a.jpg",
+                                 is_sold_out=False, occurred_at=now_almaty())
+
+
+async def consume_until(redis, handler, done, timeout=5):
+    """Runs `consume` with short reads until `done()` returns True."""
+    task = asyncio.create_task(events.consume(redis, GROUP, handler, block_ms=10))
+    try:
+        async with asyncio.timeout(timeout):
+            while not await done():
+                await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def pending_count(redis):
+    return (await redis.xpending(events.STREAM, GROUP))["pending"]
+
+
+def test_handled_entries_are_acknowledged():
+    async def check():
+        redis = fakeredis.FakeAsyncRedis()
+        handled = []
+
+        async def handler(batch):
+            handled.extend(event.name for event in batch)
+
+        await events.publish_events(redis, [fragrance_event(name) for name in ("A", "B", "C")])
+
+        async def done():
+            return len(handled) == 3
+
+        await consume_until(redis, handler, done)
+        assert handled == ["A", "B", "C"]
+        assert await pending_count(redis) == 0
+
+    asyncio.run(check())
+
+
+def test_failing_entry_is_dead_lettered_after_max_deliveries():
+    async def check():
+        redis = fakeredis.FakeAsyncRedis()
+        attempts = []
+        handled = []
+
+        async def handler(batch):
+            attempts.append([event.name for event in batch])
+            if any(event.name == "BAD" for event in batch):
+                raise ValueError("cannot handle BAD")
+            handled.extend(event.name for event in batch)
+
+        await events.publish_events(redis, [fragrance_event(name) for name in ("A", "BAD", "B")])
+
+        async def done():
+            return await redis.xlen(events.DEAD_LETTER_STREAM) == 1 and await pending_count(redis) == 0
+
+        await consume_until(redis, handler, done)
+        assert attempts.count(["A", "BAD", "B"]) == events.MAX_DELIVERIES
+        assert sorted(handled) == ["A", "B"], "the rest of the failing batch is handled on its own"
+
+        [(_, fields)] = await redis.xrange(events.DEAD_LETTER_STREAM)
+        assert (fields[b"name"], fields[b"group"], fields[b"error"]) == (b"BAD", GROUP.encode(), b"cannot handle BAD")
+
+        # The group has moved past the dead entry
+        await events.publish_events(redis, [fragrance_event("C")])
+
+        async def handled_new():
+            return "C" in handled
+
+        await consume_until(redis, handler, handled_new)
+
+    asyncio.run(check())
+
+
+def test_stale_entry_is_claimed_and_its_consumer_removed(monkeypatch):
+    monkeypatch.setattr(events, "CLAIM_IDLE_MS", 0)
+
+    async def check():
+        redis = fakeredis.FakeAsyncRedis()
+        handled = []
+
+        async def handler(batch):
+            handled.extend(event.name for event in batch)
+
+        await events.ensure_group(redis, GROUP)
+        await events.publish_events(redis, [fragrance_event("A")])
+        # A consumer reads the entry and dies before acknowledging it
+        await redis.xreadgroup(GROUP, "dead-consumer", {events.STREAM: ">"}, count=10)
+        assert await pending_count(redis) == 1
+
+        async def done():
+            return handled == ["A"] and await pending_count(redis) == 0
+
+        await consume_until(redis, handler, done)
+        consumers = [consumer["name"] for consumer in await redis.xinfo_consumers(events.STREAM, GROUP)]
+        assert consumers == [events.CONSUMER_NAME.encode()]
+
+    asyncio.run(check())
+
+
+def test_consumer_with_pending_entries_is_kept(monkeypatch):
+    monkeypatch.setattr(events, "CLAIM_IDLE_MS", 0)
+
+    async def check():
+        redis = fakeredis.FakeAsyncRedis()
+        await events.ensure_group(redis, GROUP)
+        await events.publish_events(redis, [fragrance_event("A")])
+        await redis.xreadgroup(GROUP, "busy-consumer", {events.STREAM: ">"}, count=10)
+        await redis.xgroup_createconsumer(events.STREAM, GROUP, "idle-consumer")
+
+        await events.remove_idle_consumers(redis, GROUP)
+        consumers = [consumer["name"] for consumer in await redis.xinfo_consumers(events.STREAM, GROUP)]
+        assert consumers == [b"busy-consumer"]
+
+    asyncio.run(check())
@@ -0,0 +1,72 @@
+"""Import-time budget for the bot entry point.
+
+Imports `bot` in a fresh interpreter with `-X importtime` and fails when the project's own
+import cost exceeds the budget or when a module that only the scraper, fuzzy search or the
+metrics server needs is loaded eagerly. aiogram alone builds hundreds of pydantic models on
+import, so its own import time is measured separately as the floor. The budget is a share of
+that floor, so a slower machine raises both alike.
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BUDGET = 0.3  # Allowed import time on top of aiogram, as a fraction of aiogram's own
+RUNS = 3
+
+# Modules that must stay off the startup path; they are imported on first use.
+LAZY_MODULES = ("bs4", "lxml", "fuzzywuzzy", "apscheduler", "pandas", "matplotlib", "prometheus_client")
+
+
+def measure(workdir, module="bot", floor="aiogram", runs=RUNS):
+    """Returns `(total, floor)` cumulative import times in microseconds and the imported module names.
+
+    Both times come from the same interpreter, so load on the machine slows them alike; the
+    run with the smallest difference is kept.
+    """
+    env = dict(os.environ, BOT_TOKEN=os.environ.get("BOT_TOKEN", "123456:IMPORT-TIME"), PYTHONPATH=str(ROOT))
+    best = None
+    modules = set()
+    for _ in range(runs):
+        # Importing the config creates logs/ in the working directory, keep it out of the repository
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=workdir, env=env, capture_output=True, text=True, check=True,
+        )
+        timings = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            if not cumulative.strip().isdigit():
+                continue
+            timings[name.strip()] = int(cumulative)
+        modules = set(timings)
+        run = (timings[module], timings.get(floor, 0))
+        if best is None or run[0] - run[1] < best[0] - best[1]:
+            best = run
+    return best, modules
+
+
+@pytest.fixture(scope="module")
+def import_times(tmp_path_factory):
+    return measure(tmp_path_factory.mktemp("import-time"))
+
+
+def test_heavy_modules_are_imported_lazily(import_times):
+    _, modules = import_times
+    assert sorted(name for name in modules if name.split(".")[0] in LAZY_MODULES) == []
+
+
+def test_import_time_within_budget(import_times):
+    (total_us, floor_us), _ = import_times
+    overhead_ms = max(0, total_us - floor_us) / 1000
+    budget_ms = BUDGET * floor_us / 1000
+    assert overhead_ms <= budget_ms, (
+        f"import bot: {total_us / 1000:.1f} ms, aiogram floor: {floor_us / 1000:.1f} ms, "
+        f"overhead: {overhead_ms:.1f} ms (budget {budget_ms:.0f} ms, {BUDGET:.0%} of the floor)"
+    )
@@ -0,0 +1,116 @@
+import random
+
+import pytest
+
+from src.services.subscriptions import ANYTHING_NEW, BRAND, KEYWORD, Automaton, SubscriptionIndex, is_word
+
+# A small alphabet makes overlapping and nested patterns likely
+ALPHABET = "AB "
+
+
+def random_text(rng, max_length):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(1, max_length)))
+
+
+def naive_find(patterns, text):
+    return {(start, pattern) for pattern in patterns
+            for start in range(len(text) - len(pattern) + 1) if text.startswith(pattern, start)}
+
+
+def naive_match(rules, name, include_new=False):
+    users = set()
+    for telegram_id, kind, pattern in rules:
+        if kind == ANYTHING_NEW:
+            if include_new:
+                users.add(telegram_id)
+        elif kind == BRAND:
+            if name.startswith(pattern) and is_word(name, 0, len(pattern)):
+                users.add(telegram_id)
+        elif any(is_word(name, start, start + len(pattern)) for start, _ in naive_find([pattern], name)):
+            users.add(telegram_id)
+    return users
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_automaton_finds_what_a_naive_search_finds(seed):
+    rng = random.Random(seed)
+    patterns = {random_text(rng, 4) for _ in range(rng.randint(1, 12))}
+    automaton = Automaton(patterns)
+    for _ in range(30):
+        text = random_text(rng, 30)
+        assert set(automaton.find(text)) == naive_find(patterns, text)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_index_matches_like_the_rules_say_through_adds_and_removes(seed):
+    rng = random.Random(seed)
+    index = SubscriptionIndex()
+    rules = set()
+    for _ in range(60):
+        if rules and rng.random() < 0.4:
+            rule = rng.choice(sorted(rules))
+            rules.discard(rule)
+            index.remove(*rule)
+        else:
+            kind = rng.choice([KEYWORD, KEYWORD, BRAND, ANYTHING_NEW])
+            rule = (rng.randint(1, 5), kind, "" if kind == ANYTHING_NEW else random_text(rng, 3).strip() or "A")
+            rules.add(rule)
+            index.add(*rule)
+
+        name = random_text(rng, 20)
+        include_new = rng.random() < 0.5
+        assert index.match(name, include_new=include_new) == naive_match(rules, name, include_new)
+
+
+def test_keyword_matches_whole_words_only():
+    index = SubscriptionIndex()
+    index.add(1, KEYWORD, "OUD")
+    assert index.match("MONTALE OUD") == {1}
+    assert index.match("OUD WOOD") == {1}
+    assert index.match("MONTALE OUD-SILK") == {1}
+    assert index.match("MONTALE OUDH") == set()
+    assert index.match("TOUD") == set()
+
+
+def test_brand_matches_only_at_the_start():
+    index = SubscriptionIndex()
+    index.add(1, BRAND, "MONTALE")
+    assert index.match("MONTALE OUD") == {1}
+    assert index.match("OUD BY MONTALE") == set()
+    assert index.match("MONTALEX OUD") == set()
+
+
+def test_keyword_and_brand_on_the_same_pattern():
+    index = SubscriptionIndex()
+    index.add(1, KEYWORD, "AMOUAGE")
+    index.add(2, BRAND, "AMOUAGE")
+    assert index.match("AMOUAGE INTERLUDE") == {1, 2}
+    assert index.match("NOT AMOUAGE") == {1}
+
+
+def test_removed_pattern_no_longer_matches():
+    index = SubscriptionIndex()
+    index.add(1, KEYWORD, "OUD")
+    index.add(2, KEYWORD, "OUD")
+    assert index.match("MONTALE OUD") == {1, 2}
+
+    index.remove(1, KEYWORD, "OUD")
+    assert index.match("MONTALE OUD") == {2}
+    index.remove(2, KEYWORD, "OUD")
+    assert index.match("MONTALE OUD") == set()
+    assert list(index.automaton.find("MONTALE OUD")) == []
+
+
+def test_anything_new_only_for_new_fragrances():
+    index = SubscriptionIndex()
+    index.add(1, ANYTHING_NEW)
+    assert index.match("MONTALE OUD") == set()
+    assert index.match("MONTALE OUD", include_new=True) == {1}
+    index.remove(1, ANYTHING_NEW)
+    assert index.match("MONTALE OUD", include_new=True) == set()
+
+
+def test_unknown_kind_is_ignored():
+    index = SubscriptionIndex()
+    index.add(1, "notes", "ROSE")
+    assert index.match("ROSE") == set()